@@ -25,21 +25,66 @@ import os
 import sys
 import time
 import json
-import names
+import asyncio
+import aiohttp
+import contextlib
 import configparser
 import urllib.parse
 from libs.functions import *
 from libs.logging import logger
+from aiohttp_socks import ProxyConnectionError, ProxyError, ProxyTimeoutError
 from urllib.parse import urlsplit, urlunsplit
-from multiprocessing import cpu_count, Process
-from libs.parsers import get_forms, get_links, get_title
-from libs.classes import SpiderURL
+from multiprocessing import cpu_count
+from libs.parsers import get_page, use_backend
+from libs.classes import Fault, PageReader, SpiderURL, schema_version
+from libs.control import Control
+from libs.journal import Journal
+from libs.encoders import encoders
+from libs.metrics import metrics, serve_metrics
+from libs.fingerprint import distance, from_hex, to_hex
+from libs.shared import SpiderManager
+from libs.submitter import Submitter
+from libs.supervisor import Supervisor
+from libs.torcontrol import StubController, TorController
+from libs.onion import onion_urls
+from libs.torpool import TorPool
+from libs.urls import canonical_url, join_url
+from libs.workqueue import WorkQueue
 
 '''---[ GLOBAL VARIABLES ]---'''
 
 # The current release version.
 version = '0.8'
 
+# The following lists define possible response codes that a server might send
+# in reply to our request for their url.
+
+# Redirect codes: These status codes redirect to other pages, so grab those
+# other pages and scan them instead.
+redirect_codes = [301, 302, 303, 307, 308]
+
+# Fault codes: These status codes imply that there was something wrong with
+# the page being requested, such as being non-existent. Don't rescan pages
+# with these codes.
+fault_codes = [400, 401, 403, 404, 405, 406, 410,
+               413, 414, 444, 451, 495, 496,
+               500, 501, 502, 505, 508, 511]
+
+# No-Fault codes: These imply that something temporarily went wrong, but it's
+# possible that it might work in the future. Just skip to the next url.
+no_fault_codes = [408, 421, 423, 429, 503, 504]
+
+# Good codes: These are the codes we want to see when we are accessing a web
+# service.
+good_codes = [200, 201]
+
+# Not-Modified codes: The page is online, and hasn't changed since we last
+# scanned it.
+not_modified_codes = [304]
+
+# How many bytes of a page to read at a time.
+chunk_size = 65536
+
 '''---[ CLASS DEFINITIONS ]---'''
 
 
@@ -47,7 +92,52 @@ class Spider:
     def __init__(self):
         self.api_url = api_url
         self.headers = self.__gen_api_header()
-        self.session = get_tor_session()
+        self.tor = TorPool(tor_ports, tor_isolation)
+        # Keeps all of the spiders from hammering any one onion.
+        self.scheduler = scheduler
+        # Learns how long to wait on each onion.
+        self.latency = latency
+        # Whether to send a HEAD request before fetching each page, or just
+        # a single streamed GET.
+        self.head_first = fetch_mode == 'head'
+        # The most we'll download of any one page.
+        self.max_page_size = max_page_size
+        # Tells us whether Tor itself is still working.
+        self.health = health
+        # The onions we recently found to be offline.
+        self.offline = offline
+        # The urls this node has reported lately.
+        self.seen = seen
+        self.work = WorkQueue(self._lease, lease_size)
+        self.submitter = Submitter(self.api_url + 'parse', self.headers,
+                                   ssl_verify, submit_batch, submit_wait,
+                                   encoding=submit_encoding,
+                                   journal=journal, seen=seen)
+        # Keeps track of our leased urls and unsent results on disk.
+        self.journal = journal
+        # Set by the supervisor when it wants this spider to finish up.
+        self.stop_event = None
+        # Pauses the spiders and changes their settings as they run.
+        self.control = control
+
+    def _should_stop(self):
+        # The supervisor tells each spider when to stop: when it scales down,
+        # is signalled to stop, or finds the 'sleep' file.
+        return self.stop_event is not None and self.stop_event.is_set()
+
+    def _check_control(self):
+        # Apply any settings that have changed, and return whether the
+        # spiders are paused.
+        if self.control is None:
+            return False
+        settings = self.control.changes()
+        if settings is not None:
+            self._apply_settings(settings)
+        return self.control.paused()
+
+    def _apply_settings(self, settings):
+        if 'loglevel' in settings:
+            logger.set_level(settings['loglevel'])
 
     @staticmethod
     def __gen_api_header():
@@ -58,10 +148,9 @@ class Spider:
         myhead['Authorization-Node'] = api_node
         return myhead
 
-    def __get_query(self, endpoint, query):
+    def _get_query(self, endpoint, query):
         # Request data from the backend API.
-        logger.log("Running GET Query on endpoint: {}".format(endpoint),
-                   'debug')
+        logger.log("Running GET Query on endpoint: {}", 'debug', endpoint)
         # Send the request for information from the API.
         r = requests.get(
             self.api_url + endpoint + '?q=' + urllib.parse.quote_plus(
@@ -70,8 +159,8 @@ class Spider:
             verify=ssl_verify)
         if r.status_code == 200:
             # If successful then it returns the object data.
-            logger.log('GET Query successful for endpoint: {}'.format(endpoint),
-                       'debug')
+            logger.log('GET Query successful for endpoint: {}', 'debug',
+                       endpoint)
             return json.loads(r.text).get('objects')
         elif r.status_code == 401:
             # Unauthorized.
@@ -81,297 +170,440 @@ class Spider:
             # Some other failure.
             return {}
 
-    def __post_parse(self, data):
-        # Enqueue the data to be parsed on the backend
+    def _post_parse(self, scan_result):
+        # Enqueue the scan_result to be parsed on the backend. The submitter
+        # sends it off in the background, along with the rest of its batch.
+        # Only the new urls we haven't reported lately are sent along; the
+        # submitter remembers them once the backend has them.
+        if scan_result.new_urls:
+            scan_result.new_urls = self.seen.filter(scan_result.new_urls)
         logger.log('Pushing to parse queue.', 'debug')
-        # Send the data to the backend API.
-        r = requests.post(
-            self.api_url + 'parse',
-            headers=self.headers,
-            data=data,
-            verify=ssl_verify)
-        if r.status_code == 201:
-            # If created then it returns the object data.
-            logger.log('Added successfully', 'debug')
-            return json.loads(r.text)
-        elif r.status_code == 401:
-            # Unauthorized.
-            logger.log('Receive 401 Unauthorized', 'error')
-            return {}
-        else:
-            # Some other failure.
-            return {}
+        data = scan_result.to_dict(schema)
+        # The submitter swaps the url's lease in the journal for the result,
+        # from its own thread.
+        self.submitter.submit(data, scan_result.url)
+        metrics.inc('torspider_pages_total', online=scan_result.online)
+        if scan_result.fault is not None:
+            fault = scan_result.fault
+            metrics.inc('torspider_faults_total', fault=fault.name.lower()
+                        if isinstance(fault, Fault) else fault)
+        metrics.set('torspider_submit_queue', len(self.submitter))
+
+    def _lease(self, count):
+        # Ask the API for up to count urls to scan. Returns a list of
+        # (url, last_hash, last_fingerprint, validators) tuples, which is
+        # empty if there are currently no urls to scan. The validators are
+        # the headers we can send to ask the server whether the page has
+        # changed since. Urls that spiders which have since died never got
+        # to scan come first.
+        next_urls = []
+        if self.journal is not None:
+            next_urls = self.journal.claim_leases(count)
+            if next_urls:
+                logger.log('Recovered {} leased urls.', 'debug',
+                           len(next_urls))
+                return next_urls
+        objects = self._get_query('next', {"node_name": node_name,
+                                           "count": count})
+        if isinstance(objects, dict):
+            # The backend handed us a single url.
+            objects = [objects]
+        for next_url_info in objects or []:
+            if 'hash' in next_url_info.keys() and 'url' in next_url_info.keys():
+                # We successfully retrieved a url from the API.
+                logger.log('Found next url: {}', 'debug',
+                           next_url_info.get('url'))
+                last_hash = next_url_info['hash']
+                if not last_hash:
+                    last_hash = ''
+                validators = {}
+                if next_url_info.get('etag'):
+                    validators['If-None-Match'] = next_url_info['etag']
+                if next_url_info.get('last_modified'):
+                    validators['If-Modified-Since'] = \
+                        next_url_info['last_modified']
+                next_urls.append((next_url_info['url'], last_hash,
+                                  next_url_info.get('fingerprint'), validators))
+        if next_urls and self.journal is not None:
+            self.journal.lease(next_urls)
+        return next_urls
+
+    def _fetch(self, method, url, **kwargs):
+        # Send a request through one of our Tor circuits, keeping track of
+        # how well the circuit and the onion performed. The timeout depends
+        # on how quickly the onion has responded in the past.
+        host = urlsplit(url)[1]
+        timeout = self.latency.timeout(host)
+        circuit = self.tor.choose()
+        started = time.time()
+        try:
+            response = getattr(circuit.session, method)(
+                url, timeout=timeout, **kwargs)
+        except (requests.exceptions.ConnectionError,
+                requests.exceptions.Timeout) as e:
+            self.tor.release(circuit, failed=True)
+            if isinstance(e, requests.exceptions.Timeout):
+                self.latency.record_timeout(host)
+            raise
+        except Exception as e:
+            self.tor.release(circuit)
+            raise
+        elapsed = time.time() - started
+        self.tor.release(circuit, elapsed)
+        self.latency.record(host, elapsed)
+        metrics.observe('torspider_request_seconds', elapsed,
+                        method=method.upper())
+        return response
+
+    def _forget(self, url):
+        # We won't be reporting back on this url.
+        if self.journal is not None:
+            self.journal.forget(url)
+
+    def _known_offline(self, url, host):
+        # If we recently found this onion to be offline, report the url as
+        # offline without trying to connect to it again.
+        if not self.offline.is_offline(host):
+            return False
+        logger.log('Onion is known to be offline: {}', 'debug', url)
+        self._post_parse(self._new_result(url))
+        return True
+
+    @staticmethod
+    def _new_result(url):
+        # Initialize the scan_result class.
+        scan_result = SpiderURL()
+
+        # Set the url for the scan_result.
+        scan_result.url = url
+
+        # Set the last node information in scan_result.
+        scan_result.last_node = node_name
+
+        # Store an empty redirect, just in case.
+        scan_result.redirect = None
+        return scan_result
+
+    @staticmethod
+    def _check_status(scan_result, status_code, headers, url,
+                      validators=None):
+        # Analyze the status code sent by the server. Returns True if the
+        # scan is finished and the scan_result should be sent off as-is.
+        # The validators are those the request was sent with.
+        metrics.inc('torspider_responses_total', code=status_code)
+        if status_code in not_modified_codes:
+            # The page is online, but nothing has changed. Keep its
+            # validators, preferring any the server sent along, so we can
+            # ask the same question next time.
+            logger.log('Url not modified: {}', 'debug', url)
+            scan_result.online = True
+            validators = validators or {}
+            scan_result.etag = headers.get(
+                'ETag', validators.get('If-None-Match'))
+            scan_result.last_modified = headers.get(
+                'Last-Modified', validators.get('If-Modified-Since'))
+            return True
+
+        elif status_code in redirect_codes:
+            # The url results in a redirection.
+            logger.log('Found a redirection url: {} code: {}', 'debug', url,
+                       status_code)
+            scan_result.fault = status_code
+            try:
+                # Attempt to add the redirected url to the backend.
+                location = headers['location']
+                logger.log('Found redirection url: {}', 'debug', location)
+                # Resolve the redirect against the url we scanned in
+                # order to fill in any blanks.
+                new_url = join_url(url, location)
+                if new_url is None:
+                    # It doesn't redirect to a web page.
+                    new_url = location
+                else:
+                    # Ignore any non-onion domain.
+                    scan_result.new_urls.extend(
+                        onion_urls([new_url], onion_versions))
+                # Store information about where this url redirects.
+                scan_result.redirect = new_url
+            except Exception as e:
+                # The server did not provide a redirect url.
+                logger.log("{}: couldn't find redirect. ({})", 'error',
+                           str(status_code), url)
+            return True
+
+        elif status_code in fault_codes:
+            # We received a fault code from the server.
+            logger.log('Found a fault in url: {} code: {}', 'debug', url,
+                       status_code)
+            scan_result.fault = status_code
+            return True
+
+        elif status_code in no_fault_codes:
+            # The url results in a problem, but not a fault.
+            logger.log('Found a problem url: {} code: {}', 'debug', url,
+                       status_code)
+            return True
+
+        elif status_code not in good_codes:
+            # Unknown status. More status codes will be added as
+            # they are discovered in the wild.
+            logger.log('Found a unknown status url: {} code: {}', 'debug', url,
+                       status_code)
+            logger.log("Unknown status code {}: {}", 'error', status_code, url)
+            scan_result.fault = status_code
+            return True
+
+        # If we reach this point, we know the domain is online.
+        scan_result.online = True
+
+        # Keep the page's validators, so that next time we can ask the
+        # server whether it has changed rather than downloading it again.
+        scan_result.etag = headers.get('ETag')
+        scan_result.last_modified = headers.get('Last-Modified')
+        return False
+
+    @staticmethod
+    def _check_type(scan_result, headers, url):
+        # We only want to scan plaintext files, not binary data or images.
+        # Check the content type of the data before making an attempt to
+        # process it. Returns the content type, and sets a fault on the
+        # scan_result if the content is not text-based.
+        content_type = get_type(headers)
+        logger.log("Found content type of url: {} as: {}", 'debug', url,
+                   content_type)
+        if content_type != 'text' and content_type is not None:
+            # This content is not text-based, so don't scan it.
+            scan_result.fault = Fault.TYPE
+            scan_result.fault_detail = content_type
+        return content_type
+
+    def _read_page(self, request):
+        # Download the page, up to max_page_size bytes. Returns a PageReader
+        # holding the page's text and hash.
+        reader = PageReader(get_encoding(request.headers), self.max_page_size)
+        try:
+            for chunk in request.iter_content(chunk_size):
+                if not reader.feed(chunk):
+                    # Ignore the rest of the page.
+                    break
+        finally:
+            request.close()
+        metrics.inc('torspider_bytes_total', reader.size)
+        return reader
+
+    @staticmethod
+    def _process_page(scan_result, reader, url, last_hash, last_fingerprint):
+        if reader.truncated:
+            # The page is too big to read in full, so we'll make do with
+            # what we've got.
+            logger.log('Page truncated at {} bytes: {}', 'debug', reader.size,
+                       url)
+            scan_result.fault = Fault.TRUNCATED
+
+        # Let's see if the page has changed...
+        # Get the page's sha1 hash.
+        page_hash = reader.hash()
+
+        logger.log('Page hash of url: {} is: {}', 'debug', url, page_hash)
+        logger.log('Last page hash of url: {} is: {}', 'debug', url, last_hash)
+
+        # If the hash hasn't changed, don't process the page. We don't even
+        # need to decode it.
+        if last_hash == page_hash:
+            logger.log('The hashes matched, nothing has changed.',
+                       'debug')
+            return
+
+        # Get the title, links and forms of the page, and its fingerprint if
+        # we're taking them, all in one pass.
+        started = time.time()
+        try:
+            (page_title, page_links, page_forms, fingerprint) = get_page(
+                reader.text(), url, fingerprint_pages)
+        except Exception as e:
+            logger.log('Could not parse url: {} ({})', 'error', url, e)
+            (page_title, page_links, page_forms, fingerprint) = \
+                ('Unknown', [], [], None)
+        metrics.observe('torspider_parse_seconds', time.time() - started)
+
+        if fingerprint is not None:
+            last_fingerprint = from_hex(last_fingerprint)
+            if (last_fingerprint is not None and distance(
+                    fingerprint, last_fingerprint) <= fingerprint_distance):
+                # Only a token, a timestamp or the like has changed, so
+                # there's nothing new to report.
+                logger.log('The fingerprints matched, nothing has changed.',
+                           'debug')
+                return
+            scan_result.fingerprint = to_hex(fingerprint)
+
+        scan_result.hash = page_hash
+        logger.log('Page title for url: {} is: {}', 'debug', url, page_title)
+
+        # Set the title of the url.
+        scan_result.title = page_title
+
+        # The page's HTML changed since our last scan; let's
+        # process it.
+
+        # Add the links to the database, ignoring any non-onion domain.
+        scan_result.new_urls.extend(onion_urls(page_links, onion_versions))
+
+        # Add the forms to the database.
+        for form in page_forms:
+            # Process the form's information.
+            form_dict = dict(form)
+            # TODO: Let the backend parse the form dict.
+            scan_result.form_dicts.append(form_dict)
+
+    @staticmethod
+    def _schema_fallback(scan_result, url):
+        # We got an invalid schema. Add the url with both http and
+        # https schemas to the database to see if those work.
+        (s, n, p, q, f) = urlsplit(url)
+        new_urls = []
+        for scheme in ['http', 'https']:
+            try:
+                new_urls.append(canonical_url(urlunsplit((scheme, n, p, q, f))))
+            except ValueError as e:
+                continue
+        # Ignore any non-onion domain.
+        scan_result.new_urls.extend(onion_urls(new_urls, onion_versions))
+        scan_result.fault = Fault.INVALID_SCHEMA
 
     def crawl(self):
         logger.log("Ready to explore!", 'info')
         time_to_sleep = False
         while not time_to_sleep:
-            # To stop the script, simply create an empty file called 'sleep'
-            # in the directory where TorSpider.py resides.
-            if os.path.exists('sleep'):
-                # If the 'sleep' file is detected, TorSpider knows that it
-                # is time to sleep.
+            if self._should_stop():
+                # TorSpider knows that it is time to sleep.
                 time_to_sleep = True
+            elif self._check_control():
+                # We're paused. Wait to be resumed, still watching for the
+                # word to stop.
+                self.control.wait(1)
             else:
-                # Initialize the scan_result class.
-                scan_result = SpiderURL()
-
-                # Ask the API for a url to scan.
-                next_url_info = self.__get_query('next', {"node_name": node_name})
-                if not next_url_info:
+                # Take the next url to scan from our leased urls.
+                started = time.time()
+                next_url = self.work.get(timeout=5)
+                if not next_url:
                     # There are currently no urls to scan.
-                    logger.log('We found no urls to check, sleeping for 30 seconds.', 'debug')
-                    # Wait thirty seconds before trying again.
-                    time.sleep(30)
+                    metrics.inc('torspider_idle_seconds_total',
+                                time.time() - started)
                     continue
+                (url, last_hash, last_fingerprint, validators) = next_url
 
-                if 'hash' in next_url_info.keys() and 'url' in next_url_info.keys():
-                    # We successfully retrieved a url from the API.
-                    logger.log('Found next url: {}'.format(next_url_info.get('url')), 'debug')
-                    url = next_url_info['url']
-                    last_hash = next_url_info['hash']
-                    if not last_hash:
-                        last_hash = ''
-                else:
-                    # There are currently no urls to scan.
-                    logger.log('We found no urls to check, sleeping for 30 seconds.', 'debug')
-                    # Wait thirty seconds before trying again.
-                    time.sleep(30)
+                host = urlsplit(url)[1]
+                if self._known_offline(url, host):
                     continue
 
-                # Set the url for the scan_result.
-                scan_result.url = url
-
-                # Set the last node information in scan_result.
-                scan_result.last_node = node_name
-
-                # Store an empty redirect, just in case.
-                scan_result.redirect = None
-
-                # The following lists define possible response codes that a
-                # server might send in reply to our request for their url.
-
-                # Redirect codes: These status codes redirect to other pages,
-                # so grab those other pages and scan them instead.
-                redirect_codes = [301, 302, 303, 307, 308]
-
-                # Fault codes: These status codes imply that there was
-                # something wrong with the page being requested, such as being
-                # non-existent. Don't rescan pages with these codes.
-                fault_codes = [400, 401, 403, 404, 405, 406, 410,
-                               413, 414, 444, 451, 495, 496,
-                               500, 501, 502, 505, 508, 511]
-
-                # No-Fault codes: These imply that something temporarily went
-                # wrong, but it's possible that it might work in the future.
-                # Just skip to the next url.
-                no_fault_codes = [408, 421, 423, 429, 503, 504]
+                # Make sure we aren't hammering this onion.
+                wait = self.scheduler.acquire(host)
+                if wait:
+                    # Come back to it later, and scan something else in the
+                    # meantime.
+                    self.work.defer(next_url, wait)
+                    continue
 
-                # Good codes: These are the codes we want to see when we are
-                # accessing a web service.
-                good_codes = [200, 201]
+                # Initialize the scan_result class.
+                scan_result = self._new_result(url)
 
-                # Now that we've defined the possible response codes, attempt
-                # to scrape the data from the provided url.
+                # Attempt to scrape the data from the provided url.
                 try:
-                    # Attempt to retrieve the page's headers.
-                    logger.log('Getting head of url: {}'.format(url), 'debug')
-                    head = self.session.head(url, timeout=30)
+                    if self.head_first:
+                        # Attempt to retrieve the page's headers.
+                        logger.log('Getting head of url: {}', 'debug', url)
+                        head = self._fetch('head', url, headers=validators)
+                    else:
+                        # Request the page, but hold off on downloading it
+                        # until we've looked at the headers. Redirects are
+                        # left for us to handle, just as with a HEAD request.
+                        logger.log('Getting url: {}', 'debug', url)
+                        head = self._fetch('get', url, stream=True,
+                                           allow_redirects=False,
+                                           headers=validators)
 
                     # Analyze the status code sent by the server.
-                    if head.status_code in redirect_codes:
-                        # The url results in a redirection.
-                        logger.log('Found a redirection url: {} code: {}'.format(
-                            url, head.status_code), 'debug')
-                        scan_result.fault = str(head.status_code)
-                        try:
-                            # Attempt to add the redirected url to the backend.
-                            location = head.headers['location']
-                            logger.log('Found redirection url: {}'.format(location), 'debug')
-                            # Combine the provided url with the url we scanned
-                            # in order to fill in any blanks in the redirect.
-                            new_url = merge_urls(location, url)
-                            if '.onion' in new_url and '.onion.' not in new_url:
-                                # Ignore any non-onion domain.
-                                scan_result.new_urls.append(new_url)
-                            # Store information about where this url redirects.
-                            scan_result.redirect = new_url
-                        except Exception as e:
-                            # The server did not provide a redirect url.
-                            logger.log("{}: couldn't find redirect. ({})".format(
-                                str(head.status_code), url), 'error')
-                        # We are done here, Send off the scan_result and go to next url.
-                        self.__post_parse(scan_result.to_json())
-                        continue
-
-                    elif head.status_code in fault_codes:
-                        # We received a fault code from the server.
-                        logger.log('Found a fault in url: {} code: {}'.format(
-                            url, head.status_code), 'debug')
-                        scan_result.fault = str(head.status_code)
+                    if self._check_status(scan_result, head.status_code,
+                                          head.headers, url, validators):
+                        head.close()
                         # We are done here, Send off the scan_result and go to next url.
-                        self.__post_parse(scan_result.to_json())
+                        self._post_parse(scan_result)
                         continue
 
-                    elif head.status_code in no_fault_codes:
-                        # The url results in a problem, but not a fault.
-                        logger.log('Found a problem url: {} code: {}'.format(
-                            url, head.status_code), 'debug')
+                    content_type = self._check_type(scan_result, head.headers, url)
+                    if scan_result.fault:
+                        # Close the connection without downloading the page.
+                        head.close()
                         # We are done here, Send off the scan_result and go to next url.
-                        self.__post_parse(scan_result.to_json())
+                        self._post_parse(scan_result)
                         continue
 
-                    elif head.status_code not in good_codes:
-                        # Unknown status. More status codes will be added as
-                        # they are discovered in the wild.
-                        logger.log('Found a unknown status url: {} code: {}'.format(
-                            url, head.status_code), 'debug')
-                        logger.log("Unknown status code {}: {}".format(
-                            head.status_code, url), 'error')
-                        scan_result.fault = str(head.status_code)
-                        # We are done here, Send off the scan_result and go to next url.
-                        self.__post_parse(scan_result.to_json())
-                        continue
-
-                    # If we reach this point, we know the domain is online.
-                    scan_result.online = True
-
-                    # We only want to scan plaintext files, not binary data or
-                    # images. Check the content type of the data before making
-                    # an attempt to process it.
-                    content_type = get_type(head.headers)
-                    logger.log("Found content type of url: {} as: {}".format(
-                        url, content_type), 'debug')
-                    if content_type != 'text' and content_type is not None:
-                        # This content is not text-based, so don't scan it.
-                        scan_result.fault = 'type: {0}'.format(content_type)
-                        # We are done here, Send off the scan_result and go to next url.
-                        self.__post_parse(scan_result.to_json())
-                        continue
-
-                    request = self.session.get(url, timeout=30)
-                    if content_type is None:
-                        # If we were unable to get the content type from the
-                        # headers, try to get the content type from the full
-                        # request.
-                        content_type = get_type(request.headers)
-                        logger.log("Found content type of url: {} as: {}".format(
-                            url, content_type), 'debug')
-                        if content_type != 'text' and content_type is not None:
-                            # We got a non-text content type, such as a binary
-                            # or an image file.
-                            scan_result.fault = 'type: {}'.format(content_type)
-                            # We are done here, Send off the scan_result and go to next url.
-                            self.__post_parse(scan_result.to_json())
-                            continue
-
-                    # Grab the page text
-                    page_text = request.text
-
-                    # Get the title of the page.
-                    try:
-                        page_title = get_title(page_text)
-                    except Exception as e:
-                        page_title = 'Unknown'
-                    logger.log('Page title for url: {} is: {}'.format(
-                        url, page_title), 'debug')
-
-                    # Set the title of the url.
-                    scan_result.title = page_title
-
-                    # (We set the title before we check the hash, just in case
-                    # the title wasn't set during the last scan.)
-
-                    # Let's see if the page has changed...
-                    # Get the page's sha1 hash.
-                    page_hash = get_hash(request.content)
-
-                    logger.log('Page hash of url: {} is: {}'.format(url, page_hash), 'debug')
-                    logger.log('Last page hash of url: {} is: {}'.format(url, last_hash), 'debug')
-
-                    # If the hash hasn't changed, don't process the page.
-                    if last_hash == page_hash:
-                        logger.log('The hashes matched, nothing has changed.',
-                                'debug')
-                        # We are done here, Send off the scan_result and go to
-                        # next url.
-                        self.__post_parse(scan_result.to_json())
-                        continue
-
-                    scan_result.hash = page_hash
-
-                    # The page's HTML changed since our last scan; let's
-                    # process it.
-                    page_text = request.text
-
-                    # Get the page's links.
-                    page_links = get_links(page_text, url)
-
-                    # Add the links to the database.
-                    for link_url in page_links:
-                        if '.onion' in link_url and '.onion.' not in link_url:
-                            # Ignore any non-onion domain.
-                            scan_result.new_urls.append(link_url)
-
-                    # Parse any forms on the page.
-                    logger.log('Parsing forms on url: {}'.format(url), 'debug')
-                    page_forms = get_forms(page_text)
-
-                    # Add the forms to the database.
-                    for form in page_forms:
-                        # Process the form's information.
-                        form_dict = dict(form)
-                        # TODO: Let the backend parse the form dict.
-                        scan_result.form_dicts.append(form_dict)
-
-                        # TODO: Remove this section and let the backend handle
-                        # all this processing.
+                    if self.head_first:
+                        request = self._fetch('get', url, stream=True)
+                        if content_type is None:
+                            # If we were unable to get the content type from
+                            # the headers, try to get the content type from
+                            # the full request.
+                            self._check_type(scan_result, request.headers, url)
+                            if scan_result.fault:
+                                # We got a non-text content type, such as a
+                                # binary or an image file.
+                                request.close()
+                                # We are done here, Send off the scan_result and go to next url.
+                                self._post_parse(scan_result)
+                                continue
+                    else:
+                        # We've already got the page.
+                        request = head
+
+                    # Grab the page and process it.
+                    reader = self._read_page(request)
+                    self._process_page(scan_result, reader, url, last_hash,
+                                       last_fingerprint)
 
                     # Parsing is complete for this page!
                     # Send off the scan_result.
-                    self.__post_parse(scan_result.to_json())
+                    self._post_parse(scan_result)
 
                 except requests.exceptions.InvalidURL:
                     # The url provided was invalid.
-                    logger.log("Invalid url: {}".format(url), 'error')
-                    scan_result.fault = 'invalid url'
+                    logger.log("Invalid url: {}", 'error', url)
+                    scan_result.fault = Fault.INVALID_URL
                     # Send off the scan_result.
-                    self.__post_parse(scan_result.to_json())
+                    self._post_parse(scan_result)
 
                 except requests.exceptions.InvalidSchema:
-                    # We got an invalid schema. Add the url with both http and
-                    # https schemas to the database to see if those work.
-                    (s, n, p, q, f) = urlsplit(url)
-                    for scheme in ['http', 'https']:
-                        s = scheme
-                        new_url = urlunsplit((s, n, p, q, f))
-                        if '.onion' in new_url and '.onion.' not in new_url:
-                            # Ignore any non-onion domain.
-                            scan_result.new_urls.append(new_url)
-                    scan_result.fault = 'invalid schema'
+                    # We got an invalid schema.
+                    self._schema_fallback(scan_result, url)
                     # Send off the scan_result.
-                    self.__post_parse(scan_result.to_json())
+                    self._post_parse(scan_result)
 
                 except requests.exceptions.SSLError as e:
                     # There was a problem with the site's SSL certificate.
-                    logger.log("SSL Error at {}: {}".format(url, e), 'error')
-                    scan_result.fault = 'Bad SSL'
+                    logger.log("SSL Error at {}: {}", 'error', url, e)
+                    scan_result.fault = Fault.BAD_SSL
                     # Send off the scan_result.
-                    self.__post_parse(scan_result.to_json())
+                    self._post_parse(scan_result)
 
                 except requests.exceptions.ConnectionError:
                     # We had trouble connecting to the url.
+                    logger.log("Connection error to url: {}", 'debug', url)
+                    if scan_result.online:
+                        # The onion answered, but the connection broke
+                        # before we had the page, so it isn't offline. This
+                        # might not be a permanent problem, so don't report
+                        # back, just move on.
+                        self._forget(url)
                     # First let's make sure we're still online.
-                    logger.log("Connection error to url: {}".format(url), 'debug')
-                    try:
-                        tor_ip = get_my_ip(self.session)
-                        if tor_ip:
-                            # If we've reached this point, Tor is working.
-                            # Return the scan_result, which will show that
-                            # the url is offline.
-                            # Send off the scan_result.
-                            self.__post_parse(scan_result.to_json())
-                    except Exception as e:
+                    elif self.health.is_alive():
+                        # If we've reached this point, Tor is working, so
+                        # the onion is offline. Skip its other urls for a
+                        # while, and send off the scan_result, which will
+                        # show that the url is offline.
+                        self.offline.add(host)
+                        self._post_parse(scan_result)
+                    else:
                         # We aren't connected to Tor for some reason.
                         # It might be a temporary outage, so let's wait
                         # for a little while and see if it fixes itself.
@@ -380,43 +612,367 @@ class Spider:
 
                 except requests.exceptions.Timeout:
                     # It took too long to load this page.
-                    logger.log('Request timed out: {}'.format(url), 'debug')
+                    logger.log('Request timed out: {}', 'debug', url)
                     # Send off the scan_result.
-                    self.__post_parse(scan_result.to_json())
+                    self._post_parse(scan_result)
 
                 except requests.exceptions.TooManyRedirects as e:
                     # Redirected too many times. Let's not keep trying.
-                    scan_result.fault = 'redirect'
+                    scan_result.fault = Fault.REDIRECT
                     # Send off the scan_result.
-                    self.__post_parse(scan_result.to_json())
+                    self._post_parse(scan_result)
 
                 except requests.exceptions.ChunkedEncodingError as e:
                     # Server gave bad chunk. This might not be a permanent
                     # problem, so let's just roll with it. Don't report back,
                     # just move on.
+                    self._forget(url)
                     continue
 
                 except MemoryError as e:
                     # Whatever it is, it's way too big.
-                    logger.log('Ran out of memory: {}'.format(url), 'error')
-                    scan_result.fault = 'memory error'
+                    logger.log('Ran out of memory: {}', 'error', url)
+                    scan_result.fault = Fault.MEMORY_ERROR
                     # Send off the scan_result.
-                    self.__post_parse(scan_result.to_json())
+                    self._post_parse(scan_result)
 
                 except NotImplementedError as e:
-                    logger.log("I don't know what this means: {} - {}".format(e, url), 'error')
+                    logger.log("I don't know what this means: {} - {}",
+                               'error', e, url)
                     # Don't report back, just move on.
+                    self._forget(url)
 
                 except Exception as e:
-                    logger.log('Unknown exception: {}'.format(e), 'error')
+                    logger.log('Unknown exception: {}', 'error', e)
+                    # Don't let another spider trip over it too.
+                    self._forget(url)
                     raise
                     # Don't report back, just move on.
 
+                finally:
+                    # Let the next spider have a go at this onion.
+                    self.scheduler.release(host)
+
         # If we reach this point, the main loop is finished and the spiders are
-        # going to sleep.
+        # going to sleep. Send off any results and metrics we're still
+        # holding on to.
+        self.submitter.close()
+        metrics.flush()
         logger.log("Going to sleep!", 'info')
 
 
+class AsyncSpider(Spider):
+    # The async engine scans many urls at once from a single process. Nearly
+    # all of a crawl is spent waiting on Tor circuits, so rather than blocking
+    # on one url at a time, each process runs a pool of asyncio workers that
+    # share the spider's Tor circuits. Status codes, content types and page
+    # processing are handled exactly as they are by the Spider.
+    def __init__(self):
+        Spider.__init__(self)
+        self.concurrency = concurrency
+        # Lease enough urls at once to keep all of the workers busy.
+        self.work = WorkQueue(self._lease, max(lease_size, concurrency))
+        self.time_to_sleep = False
+        # Our running workers, by number.
+        self.workers = {}
+
+    def crawl(self):
+        logger.log("Ready to explore! ({} concurrent fetches)", 'info',
+                   self.concurrency)
+        asyncio.run(self.__crawl())
+        # If we reach this point, the main loop is finished and the spiders are
+        # going to sleep. Send off any results and metrics we're still
+        # holding on to.
+        self.submitter.close()
+        metrics.flush()
+        logger.log("Going to sleep!", 'info')
+
+    async def __crawl(self):
+        # Start up the workers, all sharing our circuits through Tor.
+        self.tor.open_async(self.concurrency)
+        try:
+            self.__start_workers()
+            while self.workers:
+                # Workers come and go as the concurrency changes, so wait for
+                # them one at a time.
+                (done, pending) = await asyncio.wait(
+                    self.workers.values(), return_when=asyncio.FIRST_COMPLETED)
+                for (number, task) in list(self.workers.items()):
+                    if task in done:
+                        del self.workers[number]
+                        if task.exception() is not None:
+                            # One worker's trouble is no reason to stop the
+                            # others, so replace it.
+                            logger.log('Worker {} failed: {}', 'error',
+                                       number, task.exception())
+                if not self.time_to_sleep:
+                    self.__start_workers()
+        finally:
+            # Stop any workers still running before closing the sessions they
+            # use. The urls they were scanning stay leased, so another spider
+            # can pick them up.
+            for task in self.workers.values():
+                task.cancel()
+            await asyncio.gather(*self.workers.values(),
+                                 return_exceptions=True)
+            await self.tor.close_async()
+
+    def __start_workers(self):
+        # Start any workers we're missing. Workers numbered concurrency or
+        # higher stop by themselves.
+        for number in range(self.concurrency):
+            if number not in self.workers:
+                self.workers[number] = asyncio.create_task(
+                    self.__worker(number))
+
+    def _apply_settings(self, settings):
+        Spider._apply_settings(self, settings)
+        if settings.get('concurrency', self.concurrency) != self.concurrency:
+            logger.log('Changing from {} to {} concurrent fetches.', 'info',
+                       self.concurrency, settings['concurrency'])
+            self.concurrency = settings['concurrency']
+            self.work.resize(max(lease_size, self.concurrency))
+            self.__start_workers()
+
+    @contextlib.asynccontextmanager
+    async def __fetch(self, method, url, **kwargs):
+        # Send a request through one of our Tor circuits, keeping track of
+        # how well the circuit and the onion performed. The timeouts depend
+        # on how quickly the onion has responded in the past.
+        host = urlsplit(url)[1]
+        seconds = self.latency.timeout(host)
+        timeout = aiohttp.ClientTimeout(sock_connect=seconds,
+                                        sock_read=seconds)
+        circuit = self.tor.choose()
+        started = time.time()
+        try:
+            response = await circuit.async_session.request(
+                method, url, timeout=timeout, **kwargs)
+        except (asyncio.TimeoutError, ProxyTimeoutError):
+            self.tor.release(circuit, failed=True)
+            self.latency.record_timeout(host)
+            raise
+        except (aiohttp.ClientConnectionError, ProxyError,
+                ProxyConnectionError):
+            self.tor.release(circuit, failed=True)
+            raise
+        except Exception as e:
+            self.tor.release(circuit)
+            raise
+        elapsed = time.time() - started
+        self.tor.release(circuit, elapsed)
+        self.latency.record(host, elapsed)
+        metrics.observe('torspider_request_seconds', elapsed, method=method)
+        try:
+            yield response
+        finally:
+            response.release()
+
+    async def __call(self, func, *args):
+        # Run a blocking call, such as a backend API query, in a thread so
+        # the other workers can keep crawling in the meantime.
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, func, *args)
+
+    async def __worker(self, number):
+        while not self.time_to_sleep and number < self.concurrency:
+            if self._should_stop():
+                self.time_to_sleep = True
+                continue
+            if self._check_control():
+                # We're paused, so wait to be resumed.
+                await asyncio.sleep(1)
+                continue
+
+            # Take the next url to scan from our leased urls.
+            next_url = self.work.get(timeout=0)
+            if not next_url:
+                # There are currently no urls to scan. The work queue is
+                # already fetching more, so just give it a moment.
+                wait = self.work.ready_in(1)
+                await asyncio.sleep(wait)
+                metrics.inc('torspider_idle_seconds_total', wait)
+                continue
+            (url, last_hash, last_fingerprint, validators) = next_url
+
+            host = urlsplit(url)[1]
+            # Checking with the other spiders and sending off results means
+            # waiting on the manager, so it's done in a thread.
+            if await self.__call(self._known_offline, url, host):
+                continue
+
+            # Make sure we aren't hammering this onion.
+            wait = self.scheduler.acquire(host)
+            if wait:
+                # Come back to it later, and scan something else in the
+                # meantime. Let the other workers have a turn first, so one
+                # worker can't spin through the whole queue.
+                self.work.defer(next_url, wait)
+                await asyncio.sleep(0)
+                continue
+
+            try:
+                scan_result = await self.__scan(url, last_hash,
+                                                last_fingerprint, validators)
+            except Exception as e:
+                logger.log('Unknown exception at {}: {}', 'error', url, e)
+                if self.time_to_sleep or self._should_stop():
+                    # We're stopping, so it may well not be this url's
+                    # fault. Keep it leased for another spider to try.
+                    continue
+                # Whatever went wrong, it went wrong with this url, so don't
+                # report back on it, and carry on with the next.
+                scan_result = None
+            finally:
+                # Let the next worker have a go at this onion.
+                self.scheduler.release(host)
+            if scan_result is not None:
+                # Send off the scan_result.
+                await self.__call(self._post_parse, scan_result)
+            elif self.journal is not None:
+                # Keep the journal's disk writes off the event loop.
+                await self.__call(self._forget, url)
+
+    async def __read_page(self, request):
+        # Download the page, up to max_page_size bytes. Returns a PageReader
+        # holding the page's text and hash.
+        reader = PageReader(get_encoding(request.headers), self.max_page_size)
+        async for chunk in request.content.iter_chunked(chunk_size):
+            if not reader.feed(chunk):
+                # Ignore the rest of the page.
+                request.close()
+                break
+        metrics.inc('torspider_bytes_total', reader.size)
+        return reader
+
+    async def __scan(self, url, last_hash, last_fingerprint, validators):
+        # Scan the url, returning the scan_result to send off, or None if we
+        # shouldn't report back.
+        scan_result = self._new_result(url)
+        try:
+            if not self.head_first:
+                # Request the page, and only read it once we've looked at
+                # the headers.
+                logger.log('Getting url: {}', 'debug', url)
+                async with self.__fetch('GET', url, allow_redirects=False,
+                                        headers=validators) as request:
+                    # Analyze the status code sent by the server.
+                    if self._check_status(scan_result, request.status,
+                                          request.headers, url, validators):
+                        request.close()
+                        return scan_result
+
+                    self._check_type(scan_result, request.headers, url)
+                    if scan_result.fault:
+                        # Close the connection without downloading the page.
+                        request.close()
+                        return scan_result
+
+                    reader = await self.__read_page(request)
+                # Grab the page and process it.
+                self._process_page(scan_result, reader, url, last_hash,
+                                   last_fingerprint)
+                return scan_result
+
+            # Attempt to retrieve the page's headers.
+            logger.log('Getting head of url: {}', 'debug', url)
+            async with self.__fetch('HEAD', url, allow_redirects=False,
+                                    headers=validators) as head:
+                status_code = head.status
+                headers = head.headers
+
+            # Analyze the status code sent by the server.
+            if self._check_status(scan_result, status_code, headers, url,
+                                  validators):
+                return scan_result
+
+            content_type = self._check_type(scan_result, headers, url)
+            if scan_result.fault:
+                return scan_result
+
+            async with self.__fetch('GET', url) as request:
+                if content_type is None:
+                    # If we were unable to get the content type from the
+                    # headers, try to get the content type from the full
+                    # request.
+                    self._check_type(scan_result, request.headers, url)
+                    if scan_result.fault:
+                        return scan_result
+                reader = await self.__read_page(request)
+
+            # Grab the page and process it.
+            self._process_page(scan_result, reader, url, last_hash,
+                               last_fingerprint)
+            return scan_result
+
+        except aiohttp.InvalidURL:
+            if urlsplit(url)[0] not in ['', 'http', 'https']:
+                # We got an invalid schema.
+                self._schema_fallback(scan_result, url)
+            else:
+                # The url provided was invalid.
+                logger.log("Invalid url: {}", 'error', url)
+                scan_result.fault = Fault.INVALID_URL
+            return scan_result
+
+        except aiohttp.ClientSSLError as e:
+            # There was a problem with the site's SSL certificate.
+            logger.log("SSL Error at {}: {}", 'error', url, e)
+            scan_result.fault = Fault.BAD_SSL
+            return scan_result
+
+        except (asyncio.TimeoutError, ProxyTimeoutError):
+            # It took too long to load this page.
+            logger.log('Request timed out: {}', 'debug', url)
+            return scan_result
+
+        except aiohttp.TooManyRedirects as e:
+            # Redirected too many times. Let's not keep trying.
+            scan_result.fault = Fault.REDIRECT
+            return scan_result
+
+        except aiohttp.ClientPayloadError as e:
+            # Server gave bad chunk. This might not be a permanent problem,
+            # so let's just roll with it. Don't report back, just move on.
+            return None
+
+        except (aiohttp.ClientError, ProxyError, ProxyConnectionError):
+            # We had trouble connecting to the url, or it sent back something
+            # that isn't HTTP, such as a malformed status line, which
+            # requests reports as a connection error too.
+            logger.log("Connection error to url: {}", 'debug', url)
+            if scan_result.online:
+                # The onion answered, but the connection broke before we had
+                # the page, so it isn't offline. This might not be a
+                # permanent problem, so don't report back, just move on.
+                return None
+            # First let's make sure we're still online.
+            if await self.__call(self.health.is_alive):
+                # If we've reached this point, Tor is working, so the onion
+                # is offline. Skip its other urls for a while, and return
+                # the scan_result, which will show that the url is offline.
+                self.offline.add(urlsplit(url)[1])
+                return scan_result
+            # We aren't connected to Tor for some reason. It might be a
+            # temporary outage, so let's wait for a little while and see if
+            # it fixes itself.
+            logger.log('We seem to not be connected to Tor.', 'debug')
+            await asyncio.sleep(5)
+            return None
+
+        except MemoryError as e:
+            # Whatever it is, it's way too big.
+            logger.log('Ran out of memory: {}', 'error', url)
+            scan_result.fault = Fault.MEMORY_ERROR
+            return scan_result
+
+        except NotImplementedError as e:
+            logger.log("I don't know what this means: {} - {}", 'error', e,
+                       url)
+            # Don't report back, just move on.
+            return None
+
+
 '''---[ SCRIPT ]---'''
 
 if __name__ == '__main__':
@@ -427,15 +983,57 @@ if __name__ == '__main__':
         default_config.optionxform = lambda option: option
         default_config['TorSpider'] = {
             'LogToConsole': 'True',
+            'Engine': 'sync',
+            'Concurrency': '100',
+            'Fetch': 'stream',
+            'MaxPageSize': '5242880',
+            'Parser': 'auto',
+            'OnionVersions': '3',
+            'Fingerprint': 'False',
+            'FingerprintDistance': '3',
+            'MetricsHost': '127.0.0.1',
+            'MetricsPort': '9405',
+            'Workers': '0',
+            'MinWorkers': '1',
+            'MaxWorkers': '0',
+            'ScaleInterval': '60',
+            'StopGrace': '60',
+            'MinTimeout': '10',
+            'MaxTimeout': '30',
+            'OfflineTTL': '1800',
+            'Journal': 'journal/journal.db',
+            'JournalMaxAge': '3600',
+            'SeenCapacity': '1000000',
+            'SeenMaxAge': '21600'
         }
         default_config['API'] = {
             'API_URL': 'https://api.torspider.pro/api/',
             'API_KEY': 'Configure_api_key',
             'API_NODE': 'Configure_api_node',
-            'VERIFY_SSL': True
+            'VERIFY_SSL': True,
+            'LEASE_SIZE': '20',
+            'SUBMIT_BATCH': '50',
+            'SUBMIT_WAIT': '5',
+            'SCHEMA': '1',
+            'ENCODING': 'json'
+        }
+        default_config['TOR'] = {
+            'SOCKS_PORTS': '9050',
+            'ISOLATION': '1',
+            'CONTROL_HOST': '127.0.0.1',
+            'CONTROL_PORT': '9051',
+            'CONTROL_PASSWORD': '',
+            'CHECK_INTERVAL': '10'
+        }
+        default_config['SCHEDULER'] = {
+            'MAX_IN_FLIGHT': '4',
+            'MIN_DELAY': '0.5',
+            'RATE': '2',
+            'BURST': '10'
         }
         default_config['LOGGING'] = {
-            'loglevel': 'INFO'
+            'loglevel': 'INFO',
+            'format': 'text'
         }
         with open('spider.cfg', 'w') as config_file:
             default_config.write(config_file)
@@ -470,62 +1068,315 @@ if __name__ == '__main__':
             from requests.packages.urllib3.exceptions import InsecureRequestWarning
 
             requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
+        # How many urls to lease from the backend at once.
+        lease_size = os.environ.get('LEASE_SIZE', None)
+        if not lease_size:
+            lease_size = config['API'].get('LEASE_SIZE', '20')
+        lease_size = int(lease_size)
+        # How many results to send to the backend at once, and the longest
+        # we'll hold on to a result while waiting for a batch to fill.
+        submit_batch = os.environ.get('SUBMIT_BATCH', None)
+        if not submit_batch:
+            submit_batch = config['API'].get('SUBMIT_BATCH', '50')
+        submit_batch = int(submit_batch)
+        submit_wait = os.environ.get('SUBMIT_WAIT', None)
+        if not submit_wait:
+            submit_wait = config['API'].get('SUBMIT_WAIT', '5')
+        submit_wait = float(submit_wait)
+        # The version of the backend's schema to send results in, and how to
+        # encode them: 'json', or 'msgpack' if it's installed.
+        schema = os.environ.get('SCHEMA', None)
+        if not schema:
+            schema = config['API'].get('SCHEMA', '1')
+        schema = int(schema)
+        submit_encoding = os.environ.get('ENCODING', None)
+        if not submit_encoding:
+            submit_encoding = config['API'].get('ENCODING', 'json')
+        # The Tor SocksPorts to spread our requests over, and how many
+        # isolated circuits to use on each of them.
+        tor_ports = os.environ.get('TOR_SOCKS_PORTS', None)
+        if not tor_ports and config.has_section('TOR'):
+            tor_ports = config['TOR'].get('SOCKS_PORTS')
+        tor_ports = [int(port) for port in (tor_ports or '9050').split(',')]
+        tor_isolation = os.environ.get('TOR_ISOLATION', None)
+        if not tor_isolation and config.has_section('TOR'):
+            tor_isolation = config['TOR'].get('ISOLATION')
+        tor_isolation = int(tor_isolation or 1)
+        # Tor's control port, which we ask whether Tor is working, and how
+        # often, at most, to ask, in seconds. A CONTROL_PORT of 'stub'
+        # always reports that Tor is working.
+        tor_control = {}
+        for (option, default) in [('CONTROL_HOST', '127.0.0.1'),
+                                  ('CONTROL_PORT', '9051'),
+                                  ('CONTROL_PASSWORD', ''),
+                                  ('CHECK_INTERVAL', '10')]:
+            value = os.environ.get('TOR_' + option, None)
+            if not value and config.has_section('TOR'):
+                value = config['TOR'].get(option)
+            tor_control[option] = value or default
+        tor_check_interval = float(tor_control['CHECK_INTERVAL'])
+        if tor_control['CONTROL_PORT'] == 'stub':
+            tor_controller = StubController()
+        else:
+            tor_controller = TorController(tor_control['CONTROL_HOST'],
+                                           int(tor_control['CONTROL_PORT']),
+                                           tor_control['CONTROL_PASSWORD'])
+        # How hard we may push any one onion: the most requests it may have
+        # in flight at once, the least time between requests, and the rate
+        # and burst size of its token bucket.
+        scheduling = {}
+        for (option, default) in [('MAX_IN_FLIGHT', '4'), ('MIN_DELAY', '0.5'),
+                                  ('RATE', '2'), ('BURST', '10')]:
+            value = os.environ.get('HOST_' + option, None)
+            if not value and config.has_section('SCHEDULER'):
+                value = config['SCHEDULER'].get(option)
+            scheduling[option] = float(value or default)
+        # The shortest and longest we'll wait on an onion, in seconds. The
+        # timeout for each onion is learned from how quickly it responds.
+        min_timeout = os.environ.get('MIN_TIMEOUT', None)
+        if not min_timeout:
+            min_timeout = config['TorSpider'].get('MinTimeout', '10')
+        min_timeout = float(min_timeout)
+        max_timeout = os.environ.get('MAX_TIMEOUT', None)
+        if not max_timeout:
+            max_timeout = config['TorSpider'].get('MaxTimeout', '30')
+        max_timeout = float(max_timeout)
+        # How long to remember that an onion is offline, in seconds.
+        offline_ttl = os.environ.get('OFFLINE_TTL', None)
+        if not offline_ttl:
+            offline_ttl = config['TorSpider'].get('OfflineTTL', '1800')
+        offline_ttl = float(offline_ttl)
+        # Where to keep track of leased urls and unsent results, so they
+        # survive a crash or restart. Leave it empty to keep no journal.
+        # Leased urls older than JournalMaxAge seconds aren't picked up
+        # again, as the backend will have handed them out by then.
+        journal_path = os.environ.get('JOURNAL', None)
+        if not journal_path:
+            journal_path = config['TorSpider'].get('Journal',
+                                                   'journal/journal.db')
+        journal_max_age = os.environ.get('JOURNAL_MAX_AGE', None)
+        if not journal_max_age:
+            journal_max_age = config['TorSpider'].get('JournalMaxAge', '3600')
+        journal_max_age = float(journal_max_age)
+        # How many urls to remember having reported, and for how long, in
+        # seconds, before starting to forget them.
+        seen_capacity = os.environ.get('SEEN_CAPACITY', None)
+        if not seen_capacity:
+            seen_capacity = config['TorSpider'].get('SeenCapacity', '1000000')
+        seen_capacity = int(seen_capacity)
+        seen_max_age = os.environ.get('SEEN_MAX_AGE', None)
+        if not seen_max_age:
+            seen_max_age = config['TorSpider'].get('SeenMaxAge', '21600')
+        seen_max_age = float(seen_max_age)
+        # The crawl engine: 'sync' scans one url at a time per process, while
+        # 'async' scans up to Concurrency urls at once per process.
+        engine = os.environ.get('ENGINE', None)
+        if not engine:
+            engine = config['TorSpider'].get('Engine', 'sync')
+        concurrency = os.environ.get('CONCURRENCY', None)
+        if not concurrency:
+            concurrency = config['TorSpider'].get('Concurrency', '100')
+        concurrency = int(concurrency)
+        # How to fetch pages: 'stream' sends a single GET and decides what to
+        # do from its headers, while 'head' sends a HEAD request first.
+        fetch_mode = os.environ.get('FETCH', None)
+        if not fetch_mode:
+            fetch_mode = config['TorSpider'].get('Fetch', 'stream')
+        # The most we'll download of any one page, in bytes.
+        max_page_size = os.environ.get('MAX_PAGE_SIZE', None)
+        if not max_page_size:
+            max_page_size = config['TorSpider'].get('MaxPageSize', '5242880')
+        max_page_size = int(max_page_size)
+        # The HTML parser backend: 'auto' uses lxml if it's installed and
+        # parses pages just as html.parser does. A named backend that
+        # doesn't is passed over for html.parser too.
+        parser_backend = os.environ.get('PARSER', None)
+        if not parser_backend:
+            parser_backend = config['TorSpider'].get('Parser', 'auto')
+        # The versions of onion address to follow links to. Version 2
+        # onions no longer work on the Tor network.
+        onion_versions = os.environ.get('ONION_VERSIONS', None)
+        if not onion_versions:
+            onion_versions = config['TorSpider'].get('OnionVersions', '3')
+        onion_versions = [int(v) for v in onion_versions.split(',')]
+        # Whether to take a SimHash of each page's text, so that pages that
+        # differ in no more than FingerprintDistance of its 64 bits count as
+        # unchanged.
+        fingerprint_pages = os.environ.get('FINGERPRINT', None)
+        if fingerprint_pages:
+            fingerprint_pages = fingerprint_pages.lower() in ['true', 'yes', '1', 'on']
+        else:
+            fingerprint_pages = config['TorSpider'].getboolean('Fingerprint', False)
+        fingerprint_distance = os.environ.get('FINGERPRINT_DISTANCE', None)
+        if not fingerprint_distance:
+            fingerprint_distance = config['TorSpider'].get(
+                'FingerprintDistance', '3')
+        fingerprint_distance = int(fingerprint_distance)
+        # Where to serve live metrics for Prometheus. A MetricsPort of 0
+        # stops them being served, though they're still collected for the
+        # supervisor.
+        metrics_host = os.environ.get('METRICS_HOST', None)
+        if not metrics_host:
+            metrics_host = config['TorSpider'].get('MetricsHost', '127.0.0.1')
+        metrics_port = os.environ.get('METRICS_PORT', None)
+        if not metrics_port:
+            metrics_port = config['TorSpider'].get('MetricsPort', '9405')
+        metrics_port = int(metrics_port)
+        # How many spider processes to run. Workers is how many to start
+        # with, or 0 to pick for the engine and processor count, and every
+        # ScaleInterval seconds (0 never), the supervisor adjusts it between
+        # MinWorkers and MaxWorkers (0 for twice the starting count),
+        # going by how busy the spiders are and how quickly Tor responds.
+        # Stopping spiders get StopGrace seconds to finish up.
+        workers = os.environ.get('WORKERS', None)
+        if not workers:
+            workers = config['TorSpider'].get('Workers', '0')
+        workers = int(workers)
+        min_workers = os.environ.get('MIN_WORKERS', None)
+        if not min_workers:
+            min_workers = config['TorSpider'].get('MinWorkers', '1')
+        min_workers = int(min_workers)
+        max_workers = os.environ.get('MAX_WORKERS', None)
+        if not max_workers:
+            max_workers = config['TorSpider'].get('MaxWorkers', '0')
+        max_workers = int(max_workers)
+        scale_interval = os.environ.get('SCALE_INTERVAL', None)
+        if not scale_interval:
+            scale_interval = config['TorSpider'].get('ScaleInterval', '60')
+        scale_interval = float(scale_interval)
+        stop_grace = os.environ.get('STOP_GRACE', None)
+        if not stop_grace:
+            stop_grace = config['TorSpider'].get('StopGrace', '60')
+        stop_grace = float(stop_grace)
+        if fetch_mode not in ['stream', 'head']:
+            print('Unknown fetch mode: {}. Please update your spider.cfg file.'.format(fetch_mode))
+            sys.exit(0)
+        if engine not in ['sync', 'async']:
+            print('Unknown engine: {}. Please update your spider.cfg file.'.format(engine))
+            sys.exit(0)
+        if submit_encoding not in encoders:
+            print('Unknown or unavailable encoding: {}. Please update your spider.cfg file.'.format(
+                submit_encoding))
+            sys.exit(0)
+        if schema not in range(1, schema_version + 1):
+            print('Unknown schema: {}. Please update your spider.cfg file.'.format(schema))
+            sys.exit(0)
     except Exception as e:
         print('Could not parse spider.cfg. Please verify its syntax.')
         sys.exit(0)
     logger.log('-' * 40, 'info')
-    logger.log('TorSpider v{} Initializing...'.format(version), 'info')
+    logger.log('TorSpider v{} Initializing...', 'info', version)
+
+    # Choose how we'll parse HTML.
+    try:
+        logger.log('Parsing HTML with {}.', 'info',
+                   use_backend(parser_backend))
+    except ValueError as e:
+        print('{}. Please update your spider.cfg file.'.format(e))
+        sys.exit(0)
 
-    # Create a Tor session and check if it's working.
-    logger.log("Establishing Tor connection...", 'info')
-    session = get_tor_session()
+    # Start up the objects that all of the spiders share.
+    manager = SpiderManager()
+    manager.start()
+    health = manager.TorHealth(tor_controller, tor_check_interval)
+
+    # Check if Tor is working.
+    logger.log("Verifying Tor connection...", 'info')
     while True:
+        (tor_alive, reason) = health.status()
+        if tor_alive:
+            logger.log("Tor connection established.", 'info')
+            break
+        logger.log("Tor connection failed: {}", 'error', reason)
+        time.sleep(5)
+
+    scheduler = manager.HostScheduler(int(scheduling['MAX_IN_FLIGHT']),
+                                      scheduling['MIN_DELAY'],
+                                      scheduling['RATE'],
+                                      scheduling['BURST'])
+    latency = manager.LatencyTracker(min_timeout=min_timeout,
+                                     max_timeout=max_timeout)
+    offline = manager.OfflineCache(offline_ttl)
+    seen = manager.SeenFilter(seen_capacity, seen_max_age)
+    collector = manager.MetricsCollector()
+    metrics.connect(collector)
+    control = Control(manager.Settings())
+    journal = None
+    if journal_path:
+        # None of the spiders are running yet, so whatever the journal holds
+        # was left by the last run. Hand it all out again.
+        journal = Journal(journal_path, journal_max_age)
+        journal.orphan()
+        (pending_leases, pending_results) = journal.pending()
+        # The spiders open their own connections, and mustn't inherit ours.
+        journal.close()
+        if pending_leases or pending_results:
+            logger.log('Resuming {} leased urls and {} unsent results.',
+                       'info', pending_leases, pending_results)
+    if metrics_port:
         try:
-            logger.log("Verifying Tor connection...", 'info')
-            local_ip = get_my_ip(None)
-            if not local_ip:
-                logger.log("Cannot determine local IP address.", 'error')
-            tor_ip = get_my_ip(session)
-            if not tor_ip:
-                logger.log("Cannot determine tor IP address.", 'error')
-            if local_ip == tor_ip:
-                logger.log("Tor connection failed: IPs match.", 'error')
-            else:
-                logger.log("Tor connection established.", 'info')
-                break
-        except Exception as e:
-            logger.log("Tor connection failed: {}".format(e), 'error')
-            time.sleep(5)
+            serve_metrics(collector, metrics_host, metrics_port)
+            logger.log('Serving metrics at http://{}:{}/metrics', 'info',
+                       metrics_host, metrics_port)
+        except OSError as e:
+            logger.log('Could not serve metrics: {}', 'error', e)
+
+    def reload_settings():
+        # Read the settings that can be changed while the spiders run from
+        # spider.cfg again. As at startup, the environment overrides it.
+        config = configparser.ConfigParser()
+        config.read('spider.cfg')
+        loglevel = os.environ.get('LogLevel', None)
+        if not loglevel:
+            loglevel = config['LOGGING'].get('loglevel', 'INFO')
+        concurrency = os.environ.get('CONCURRENCY', None)
+        if not concurrency:
+            concurrency = config['TorSpider'].get('Concurrency', '100')
+        concurrency = int(concurrency)
+        min_timeout = os.environ.get('MIN_TIMEOUT', None)
+        if not min_timeout:
+            min_timeout = config['TorSpider'].get('MinTimeout', '10')
+        min_timeout = float(min_timeout)
+        max_timeout = os.environ.get('MAX_TIMEOUT', None)
+        if not max_timeout:
+            max_timeout = config['TorSpider'].get('MaxTimeout', '30')
+        max_timeout = float(max_timeout)
+        if concurrency < 1:
+            raise ValueError('Concurrency must be at least 1')
+        # The timeouts live in the shared latency tracker, and this process
+        # logs too, so those change here. The spiders do the rest.
+        logger.set_level(loglevel)
+        latency.set_bounds(min_timeout, max_timeout)
+        settings = {'loglevel': loglevel}
+        if engine == 'async':
+            settings['concurrency'] = concurrency
+        return settings
 
     # Awaken the spiders!
-    Spiders = []
-    Spider_Procs = []
-
     logger.log('Waking the Spiders...', 'info')
-    my_names = []
-
-    # We'll start two processes for every processor.
-    count = (cpu_count() * 2)
-    for x in range(count):
-        spider = Spider()
-        spider_proc = Process(target=spider.crawl)
-        spider_proc.name = names.get_first_name()
-        while spider_proc.name in my_names:
-            spider_proc.name = names.get_first_name()
-        my_names.append(spider_proc.name)
-        Spider_Procs.append(spider_proc)
-        Spiders.append(spider)
-        spider_proc.start()
-        # We make them sleep a second so they don't all go skittering after
-        # the same url at the same time.
-        time.sleep(1)
-
-    for spider_proc in Spider_Procs:
-        spider_proc.join()
+
+    count = workers
+    if not count:
+        if engine == 'async':
+            # Each async process scans many urls at once, so one process for
+            # every processor is plenty.
+            count = cpu_count()
+        else:
+            # We'll start two processes for every processor.
+            count = (cpu_count() * 2)
+    supervisor = Supervisor(AsyncSpider if engine == 'async' else Spider,
+                            count, min_workers, max_workers or count * 2,
+                            collector,
+                            slots=concurrency if engine == 'async' else 1,
+                            interval=scale_interval, grace=stop_grace,
+                            control=control, reload=reload_settings,
+                            journal=journal)
+    supervisor.run()
 
     try:
         os.unlink('sleep')
     except Exception as e:
         pass
+    manager.shutdown()
     logger.log('The Spiders have gone to sleep. ZzZzz...', 'info')
     logger.log('-' * 40, 'info')
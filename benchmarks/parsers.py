@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+
+# Parsers – Benchmark libs/parsers.py, and check it against golden outputs.
+#
+# Every page in benchmarks/corpus is parsed with get_title, get_links,
+# get_forms and get_page, using each HTML backend, and the results are
+# checked against html.parser's, as recorded in benchmarks/corpus/golden.json,
+# so an optimization or another backend can be shown to change nothing. Any
+# difference is a failure, except that a backend which wasn't asked for by
+# name is only warned about, and left out. Then each function is timed over
+# the whole corpus with the backends that passed, and its throughput
+# reported in MB of HTML, and for those that find links, in links per
+# second.
+#
+# The corpus holds link farms, malformed markup, giant forms and pages in
+# other character sets. A page named name.charset.html is decoded from that
+# charset just as the spiders would, and any other page from UTF-8.
+#
+# Usage:
+#   python3 benchmarks/parsers.py
+#   python3 benchmarks/parsers.py --check-only
+#   python3 benchmarks/parsers.py --update    # After an intended change.
+#   python3 benchmarks/parsers.py -b html.parser
+#   python3 benchmarks/parsers.py --save baseline.json
+#   python3 benchmarks/parsers.py --compare baseline.json
+
+
+import os
+import sys
+import json
+import time
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from libs import parsers
+from libs.classes import PageReader
+from libs.fingerprint import to_hex
+
+corpus_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'corpus')
+golden_path = os.path.join(corpus_dir, 'golden.json')
+
+# The url the pages are parsed as having come from.
+page_url = ('http://qdntfhsjnmkp7ni5aff2nyondmop7als6w4cg4pz72emxsntjpnaq4ad'
+            '.onion/dir/page.html')
+
+# The backend whose results are recorded, and the others compared with.
+reference = 'html.parser'
+
+# The functions to check and time, by name. Each is called with the text
+# and the backend to parse it with.
+functions = {
+    'get_title': lambda text, using: parsers.get_title(text, using),
+    'get_links': lambda text, using: parsers.get_links(text, page_url, using),
+    'get_forms': lambda text, using: parsers.get_forms(text, using),
+    'get_page': lambda text, using: parsers.get_page(text, page_url, False,
+                                                     using),
+    'get_page+fingerprint': lambda text, using: parsers.get_page(
+        text, page_url, True, using)
+}
+
+# The functions that find links, whose throughput is also given in links.
+link_functions = ['get_links', 'get_page', 'get_page+fingerprint']
+
+
+def load_corpus():
+    # Return a list of (name, size in bytes, text) for each page.
+    pages = []
+    for name in sorted(os.listdir(corpus_dir)):
+        if not name.endswith('.html'):
+            continue
+        parts = name.split('.')
+        reader = PageReader(parts[-2] if len(parts) > 2 else 'utf-8')
+        with open(os.path.join(corpus_dir, name), 'rb') as page:
+            reader.feed(page.read())
+        pages.append((name, reader.size, reader.text()))
+    return pages
+
+
+def outputs(text, using):
+    # Return what each function makes of the page, as it would be stored in
+    # JSON. The order of the links doesn't matter.
+    (title, links, forms, fingerprint) = functions['get_page+fingerprint'](
+        text, using)
+    return json.loads(json.dumps({
+        'get_title': functions['get_title'](text, using),
+        'get_links': sorted(functions['get_links'](text, using)),
+        'get_forms': functions['get_forms'](text, using),
+        'get_page': [title, sorted(links), forms, to_hex(fingerprint)]
+    }))
+
+
+def first_difference(expected, found):
+    # Describe where two results first differ.
+    if isinstance(expected, list) and isinstance(found, list):
+        for (n, (a, b)) in enumerate(zip(expected, found)):
+            if a != b:
+                return '[{}]: {}'.format(n, first_difference(a, b))
+        return 'expected {} items, found {}'.format(len(expected), len(found))
+    if isinstance(expected, dict) and isinstance(found, dict):
+        for key in sorted(set(expected) | set(found), key=str):
+            if expected.get(key) != found.get(key):
+                return '[{!r}]: {}'.format(key, first_difference(
+                    expected.get(key), found.get(key)))
+    return 'expected {!r}, found {!r}'.format(expected, found)
+
+
+def check(pages, backends, golden):
+    # Compare each backend's results with the golden outputs. Returns a
+    # list of the differences.
+    failures = []
+    for backend in backends:
+        for (name, size, text) in pages:
+            expected = golden.get(name)
+            if expected is None:
+                failures.append('{}: no golden outputs; run with '
+                                '--update'.format(name))
+                continue
+            found = outputs(text, backend)
+            for function in sorted(expected):
+                if found[function] != expected[function]:
+                    failures.append('{} ({}, {}): {}'.format(
+                        name, backend, function, first_difference(
+                            expected[function], found[function])))
+    return failures
+
+
+def update(pages):
+    # Record the reference backend's current results as the golden outputs.
+    golden = {name: outputs(text, reference) for (name, size, text) in pages}
+    with open(golden_path, 'w', encoding='utf-8') as golden_file:
+        json.dump(golden, golden_file, indent=1, sort_keys=True,
+                  ensure_ascii=False)
+        golden_file.write('\n')
+    print('Recorded golden outputs for {} pages with {}.'.format(
+        len(pages), reference))
+
+
+def measure(function, backend, pages, seconds, repeats=3):
+    # Time the function over all of the pages with the backend, for at least
+    # seconds at a time, and return the best number of passes over the
+    # corpus per second.
+    best = 0
+    for x in range(repeats):
+        passes = 0
+        started = time.perf_counter()
+        while True:
+            for (name, size, text) in pages:
+                function(text, backend)
+            passes += 1
+            elapsed = time.perf_counter() - started
+            if elapsed >= seconds:
+                break
+        best = max(best, passes / elapsed)
+    return best
+
+
+def benchmark(pages, backends, golden, seconds):
+    # Return {'backend function': {'mb_per_second': MB/s,
+    # 'links_per_second': links/s}}, leaving out links/s for functions that
+    # don't find links.
+    size = sum(size for (name, size, text) in pages)
+    links = sum(len(golden[name]['get_links'])
+                for (name, size, text) in pages)
+    results = {}
+    print('{:<12} {:<22} {:>9} {:>11}'.format('backend', 'function', 'MB/s',
+                                              'links/s'))
+    for backend in backends:
+        for (function_name, function) in functions.items():
+            rate = measure(function, backend, pages, seconds)
+            stats = {'mb_per_second': rate * size / 1048576}
+            if function_name in link_functions:
+                stats['links_per_second'] = rate * links
+            results['{} {}'.format(backend, function_name)] = stats
+            print('{:<12} {:<22} {:>9.2f} {:>11}'.format(
+                backend, function_name, stats['mb_per_second'],
+                '{:.0f}'.format(stats['links_per_second'])
+                if 'links_per_second' in stats else '-'))
+    return results
+
+
+def compare(results, baseline, tolerance):
+    # Return a line for each measurement that's got slower than in the
+    # baseline.
+    regressions = []
+    for (key, stats) in results.items():
+        then = baseline.get(key, {}).get('mb_per_second')
+        if then and (then - stats['mb_per_second']) / then > tolerance:
+            regressions.append('{}: {:.2f} MB/s, down from {:.2f}'.format(
+                key, stats['mb_per_second'], then))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the HTML parsers, and check them against '
+                    'golden outputs.')
+    parser.add_argument('-b', '--backend', action='append',
+                        choices=sorted(parsers.backends),
+                        help='A backend to use, which must match the golden '
+                             'outputs (default: all installed that do)')
+    parser.add_argument('--seconds', type=float, default=0.5,
+                        help='How long to time each function for, at least '
+                             '(default: 0.5)')
+    parser.add_argument('--check-only', action='store_true',
+                        help="Check the golden outputs, but don't benchmark")
+    parser.add_argument('--update', action='store_true',
+                        help="Record html.parser's current results as the "
+                             'golden outputs')
+    parser.add_argument('--save', help='Save the results to this JSON file')
+    parser.add_argument('--compare',
+                        help='Compare the results with those saved in this '
+                             'JSON file, and fail on any regression')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='How much slower than the baseline counts as a '
+                             'regression (default: 0.1)')
+    args = parser.parse_args()
+
+    pages = load_corpus()
+    backends = args.backend or sorted(parsers.backends)
+    if args.update:
+        update(pages)
+    with open(golden_path, encoding='utf-8') as golden_file:
+        golden = json.load(golden_file)
+
+    failed = False
+    for backend in list(backends):
+        failures = check(pages, [backend], golden)
+        if not failures:
+            continue
+        if args.backend or backend == reference:
+            for line in failures:
+                print('MISMATCH: ' + line)
+            failed = True
+        else:
+            # It wasn't asked for, so it can't be used, but nothing's broken.
+            print('WARNING: {} differs from the golden outputs in {} '
+                  'places, so it is left out; first: {}'.format(
+                      backend, len(failures), failures[0]))
+            backends.remove(backend)
+    if failed:
+        sys.exit(1)
+    print('All {} pages match their golden outputs with {}.'.format(
+        len(pages), ', '.join(backends)))
+    if args.check_only:
+        return
+
+    results = benchmark(pages, backends, golden, args.seconds)
+    if args.save:
+        with open(args.save, 'w') as save_file:
+            json.dump(results, save_file, indent=2)
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+        regressions = compare(results, baseline, args.tolerance)
+        for line in regressions:
+            print('REGRESSION: ' + line)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,629 @@
+#!/usr/bin/env python3
+
+# Replay – Benchmark the crawl pipeline offline, without Tor or the backend.
+#
+# TorSpider.py is run against stand-ins for both: a fake SOCKS proxy that
+# serves a corpus of onion sites itself, and a mock API that hands out the
+# corpus's urls from 'next' and takes the results at 'parse'. The corpus is
+# generated from a seed, so every run crawls the same sites: ordinary pages,
+# redirects, faults, binaries, huge pages, slow pages and offline onions.
+# Recorded pages can be served in place of the generated ones with --pages.
+#
+# For each engine configuration, it reports pages per second, how long urls
+# took from being leased to their results arriving (p50 and p99), the CPU
+# time used by all of TorSpider's processes, and their peak memory use.
+#
+# Usage:
+#   python3 benchmarks/replay.py
+#   python3 benchmarks/replay.py --urls 2000 -c engine=async,concurrency=200
+#   python3 benchmarks/replay.py --save baseline.json
+#   python3 benchmarks/replay.py --compare baseline.json
+
+
+import os
+import sys
+import gzip
+import json
+import time
+import base64
+import random
+import shutil
+import signal
+import socket
+import asyncio
+import hashlib
+import argparse
+import resource
+import tempfile
+import threading
+import subprocess
+import configparser
+import urllib.parse
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+script = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'TorSpider.py')
+
+# The engine configurations to run when none are given.
+default_configs = [
+    'engine=sync,workers=4',
+    'engine=async,workers=1,concurrency=100',
+    'engine=async,workers=2,concurrency=100'
+]
+
+# Short names for the spider.cfg options a configuration can set. Any other
+# option can be set as Section.Option=value.
+options = {
+    'engine': ('TorSpider', 'Engine'),
+    'workers': ('TorSpider', 'Workers'),
+    'concurrency': ('TorSpider', 'Concurrency'),
+    'fetch': ('TorSpider', 'Fetch'),
+    'parser': ('TorSpider', 'Parser'),
+    'fingerprint': ('TorSpider', 'Fingerprint'),
+    'journal': ('TorSpider', 'Journal'),
+    'schema': ('API', 'SCHEMA'),
+    'encoding': ('API', 'ENCODING'),
+    'lease': ('API', 'LEASE_SIZE'),
+    'batch': ('API', 'SUBMIT_BATCH'),
+    'wait': ('API', 'SUBMIT_WAIT'),
+    'isolation': ('TOR', 'ISOLATION')
+}
+
+# How often each kind of url turns up in the corpus.
+kinds = {
+    'page': 62,
+    'redirect': 8,
+    'missing': 5,
+    'broken': 3,
+    'busy': 2,
+    'binary': 6,
+    'huge': 3,
+    'slow': 6,
+    'dead': 5
+}
+
+words = ('market forum wiki index hidden service onion mirror archive news '
+         'board library search directory about contact login register help '
+         'post thread reply user admin gallery file upload download shop '
+         'escrow vendor review link list secure anonymous private').split()
+
+
+'''---[ CORPUS ]---'''
+
+
+def onion_address(rng):
+    # A valid v3 onion address, from a random key.
+    key = bytes(rng.getrandbits(8) for x in range(32))
+    checksum = hashlib.sha3_256(b'.onion checksum' + key + b'\x03').digest()
+    return '{}.onion'.format(base64.b32encode(
+        key + checksum[:2] + b'\x03').decode('ascii').lower())
+
+
+def make_page(rng, urls):
+    # An ordinary page, linking to other pages in the corpus, to pages on
+    # its own site, and to places the spiders should ignore.
+    title = ' '.join(rng.choice(words) for x in range(rng.randint(1, 6)))
+    parts = ['<!DOCTYPE html><html><head><meta charset="utf-8">',
+             '<title>{}</title>'.format(title.title()),
+             '<style>body {{ color: #{:06x}; }}</style>'.format(
+                 rng.getrandbits(24)),
+             '<script>var x = "<a href=\'/nope\'>";</script></head><body>']
+    links = rng.sample(urls, min(rng.randint(10, 50), len(urls)))
+    links += ['/{}/{}'.format(rng.choice(words), rng.randint(0, 999))
+              for x in range(rng.randint(0, 10))]
+    links += ['https://www.example.com/{}'.format(rng.choice(words)),
+              'http://{}.onion/'.format(rng.choice(words)),
+              'mailto:{}@example.com'.format(rng.choice(words))]
+    rng.shuffle(links)
+    for link in links:
+        text = ' '.join(rng.choice(words) for x in range(rng.randint(5, 40)))
+        parts.append('<p>{} <a href="{}">{}</a></p>'.format(
+            text, link, rng.choice(words)))
+    if rng.random() < 0.3:
+        parts.append('<form action="/{}" method="post">'.format(
+            rng.choice(words)))
+        for x in range(rng.randint(1, 8)):
+            parts.append('<input type="text" name="{}{}">'.format(
+                rng.choice(words), x))
+        parts.append('<input type="submit" value="Go"></form>')
+    parts.append('</body></html>')
+    return ''.join(parts).encode('utf-8')
+
+
+class Corpus:
+    # The onion sites the spiders crawl. Each url's path says what kind of
+    # url it is, and a few of the onions are offline altogether.
+    def __init__(self, count, seed=0, pages_dir=None):
+        rng = random.Random(seed)
+        hosts = [onion_address(rng) for x in range(max(count // 5, 1))]
+        self.hosts = set(hosts)
+        self.offline = set()
+        self.urls = []
+        self.pages = {}
+        (names, weights) = zip(*kinds.items())
+        for n in range(count):
+            kind = rng.choices(names, weights)[0]
+            host = rng.choice(hosts)
+            if kind == 'dead':
+                self.offline.add(host)
+            self.urls.append('http://{}/{}/{}'.format(host, kind, n))
+        recorded = []
+        if pages_dir:
+            recorded = [os.path.join(pages_dir, name)
+                        for name in sorted(os.listdir(pages_dir))]
+        for (n, url) in enumerate(self.urls):
+            (scheme, host, path, query, fragment) = urllib.parse.urlsplit(url)
+            kind = path.split('/')[1]
+            if kind in ['page', 'slow']:
+                if recorded:
+                    with open(recorded[n % len(recorded)], 'rb') as page:
+                        self.pages[path] = page.read()
+                else:
+                    self.pages[path] = make_page(rng, self.urls)
+            elif kind == 'redirect':
+                self.pages[path] = rng.choice(self.urls).encode('ascii')
+        self.delays = {path: rng.uniform(1, 3) for path in self.pages
+                       if path.startswith('/slow/')}
+        self.binary = bytes(rng.getrandbits(8) for x in range(4096)) * 128
+        # Bigger than the MaxPageSize of 5 MiB.
+        self.huge = b'<p>' + b'spider ' * 1000 + b'</p>'
+        self.huge = self.huge * (6 * 1048576 // len(self.huge))
+
+    def respond(self, path):
+        # Return the (status, content type, body, delay) to answer with.
+        kind = path.split('/')[1] if path.count('/') >= 2 else None
+        if kind in ['page', 'slow'] and path in self.pages:
+            return (200, 'text/html; charset=utf-8', self.pages[path],
+                    self.delays.get(path, 0))
+        if kind == 'redirect':
+            return (301, self.pages[path].decode('ascii'), b'', 0)
+        if kind == 'missing':
+            return (404, 'text/html', b'<html>Not Found</html>', 0)
+        if kind == 'broken':
+            return (500, 'text/html', b'<html>Server Error</html>', 0)
+        if kind == 'busy':
+            return (503, 'text/html', b'<html>Try Later</html>', 0)
+        if kind == 'binary':
+            return (200, 'application/octet-stream', self.binary, 0)
+        if kind == 'huge':
+            return (200, 'text/html', self.huge, 0)
+        return (404, 'text/html', b'<html>Not Found</html>', 0)
+
+
+'''---[ FAKE TOR ]---'''
+
+
+class FakeTor:
+    # A SOCKS5 proxy that, rather than connecting anywhere, answers the HTTP
+    # requests sent through it from the corpus. Onions that aren't in the
+    # corpus, or are offline, are unreachable, just as they are through Tor.
+    def __init__(self, corpus):
+        self.corpus = corpus
+        self.loop = asyncio.new_event_loop()
+        self.server = self.loop.run_until_complete(
+            asyncio.start_server(self.__handle, '127.0.0.1', 0))
+        self.port = self.server.sockets[0].getsockname()[1]
+        threading.Thread(target=self.loop.run_forever, daemon=True).start()
+
+    async def __handle(self, reader, writer):
+        try:
+            (version, count) = await reader.readexactly(2)
+            methods = await reader.readexactly(count)
+            if 2 in methods:
+                # TorSpider isolates its circuits with SOCKS credentials.
+                writer.write(b'\x05\x02')
+                (version, length) = await reader.readexactly(2)
+                await reader.readexactly(length)
+                (length,) = await reader.readexactly(1)
+                await reader.readexactly(length)
+                writer.write(b'\x01\x00')
+            else:
+                writer.write(b'\x05\x00')
+            (version, command, reserved, kind) = await reader.readexactly(4)
+            if kind == 3:
+                (length,) = await reader.readexactly(1)
+                host = (await reader.readexactly(length)).decode('ascii')
+            elif kind == 1:
+                host = socket.inet_ntoa(await reader.readexactly(4))
+            else:
+                host = socket.inet_ntop(socket.AF_INET6,
+                                        await reader.readexactly(16))
+            await reader.readexactly(2)
+            if host not in self.corpus.hosts or host in self.corpus.offline:
+                # Host unreachable.
+                writer.write(b'\x05\x04\x00\x01' + bytes(6))
+                return
+            writer.write(b'\x05\x00\x00\x01' + bytes(6))
+            await self.__serve(reader, writer)
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def __serve(self, reader, writer):
+        # Answer HTTP requests until the client is done with the connection.
+        while True:
+            try:
+                head = await reader.readuntil(b'\r\n\r\n')
+            except asyncio.IncompleteReadError:
+                return
+            lines = head.decode('latin-1').split('\r\n')
+            (method, target, version) = lines[0].split(' ', 2)
+            headers = {}
+            for line in lines[1:]:
+                if ':' in line:
+                    (key, value) = line.split(':', 1)
+                    headers[key.strip().lower()] = value.strip()
+            if int(headers.get('content-length', 0)):
+                await reader.readexactly(int(headers['content-length']))
+            path = urllib.parse.urlsplit(target).path
+            (status, content_type, body, delay) = self.corpus.respond(path)
+            if delay:
+                await asyncio.sleep(delay)
+            response = ['HTTP/1.1 {} {}'.format(status, 'Status'),
+                        'Content-Length: {}'.format(len(body))]
+            if 300 <= status < 400:
+                response.append('Location: {}'.format(content_type))
+            else:
+                response.append('Content-Type: {}'.format(content_type))
+            writer.write(('\r\n'.join(response) + '\r\n\r\n').encode('ascii'))
+            if method != 'HEAD':
+                for start in range(0, len(body), 65536):
+                    writer.write(body[start:start + 65536])
+                    await writer.drain()
+            await writer.drain()
+            if headers.get('connection', '').lower() == 'close':
+                return
+
+
+'''---[ MOCK BACKEND ]---'''
+
+
+class Backend:
+    # Hands out urls from 'next' and takes results at 'parse', keeping
+    # track of when each url was leased and when its result arrived.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset([])
+        backend = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                (path, query) = urllib.parse.urlsplit(self.path)[2:4]
+                if not path.endswith('/next'):
+                    self.send_error(404)
+                    return
+                query = json.loads(urllib.parse.parse_qs(query)['q'][0])
+                body = json.dumps({'objects': backend.lease(
+                    int(query.get('count', 1)))}).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_POST(self):
+                payload = self.rfile.read(int(self.headers['Content-Length']))
+                if self.headers.get('Content-Encoding') == 'gzip':
+                    payload = gzip.decompress(payload)
+                if self.headers.get('Content-Type') == 'application/msgpack':
+                    results = msgpack.unpackb(payload)
+                else:
+                    results = json.loads(payload)
+                backend.parse(results)
+                self.send_response(201)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.port = self.server.server_port
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def reset(self, urls):
+        with self.lock:
+            self.queue = deque(urls)
+            self.total = len(urls)
+            self.leased = {}
+            self.results = {}
+            self.last_result = None
+
+    def lease(self, count):
+        now = time.time()
+        objects = []
+        with self.lock:
+            while self.queue and len(objects) < count:
+                url = self.queue.popleft()
+                self.leased[url] = now
+                objects.append({'url': url, 'hash': '', 'etag': None,
+                                'last_modified': None, 'fingerprint': None})
+        return objects
+
+    def parse(self, results):
+        now = time.time()
+        with self.lock:
+            for result in results:
+                url = result.get('url')
+                if url in self.leased and url not in self.results:
+                    self.results[url] = now
+                    self.last_result = now
+
+    def done(self):
+        with self.lock:
+            return len(self.results) >= self.total
+
+    def progress(self):
+        with self.lock:
+            return (len(self.results), self.last_result)
+
+    def latencies(self):
+        with self.lock:
+            return sorted(finished - self.leased[url]
+                          for (url, finished) in self.results.items())
+
+    def elapsed(self):
+        with self.lock:
+            if not self.results:
+                return None
+            return max(self.results.values()) - min(self.leased.values())
+
+
+'''---[ RUNNING ]---'''
+
+
+def write_config(path, settings, backend, tor):
+    # Write a spider.cfg pointing TorSpider at the stand-ins.
+    config = configparser.RawConfigParser()
+    config.optionxform = lambda option: option
+    config['TorSpider'] = {
+        'LogToConsole': 'False',
+        'MetricsPort': '0',
+        'ScaleInterval': '0'
+    }
+    config['API'] = {
+        'API_URL': 'http://127.0.0.1:{}/api/'.format(backend.port),
+        'API_KEY': 'benchmark',
+        'API_NODE': 'benchmark',
+        'VERIFY_SSL': 'False',
+        'SUBMIT_WAIT': '1'
+    }
+    config['TOR'] = {
+        'SOCKS_PORTS': str(tor.port),
+        'CONTROL_PORT': 'stub'
+    }
+    config['SCHEDULER'] = {
+        'MAX_IN_FLIGHT': '4',
+        'MIN_DELAY': '0.5',
+        'RATE': '2',
+        'BURST': '10'
+    }
+    config['LOGGING'] = {
+        'loglevel': 'WARNING',
+        'format': 'text'
+    }
+    for (name, value) in settings.items():
+        (section, option) = options.get(name) or name.split('.', 1)
+        if section not in config:
+            config[section] = {}
+        config[section][option] = value
+    with open(path, 'w') as config_file:
+        config.write(config_file)
+
+
+def parse_config(text):
+    settings = {}
+    for setting in text.split(','):
+        (name, value) = setting.split('=', 1)
+        name = name.strip()
+        if name not in options and '.' not in name:
+            raise ValueError('Unknown option: {}'.format(name))
+        settings[name] = value.strip()
+    return settings
+
+
+def tree_rss(root):
+    # The memory in use by a process and all of its descendants, in bytes,
+    # or None if we can't tell.
+    if not os.path.isdir('/proc'):
+        return None
+    children = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open('/proc/{}/stat'.format(entry)) as stat:
+                parent = int(stat.read().rsplit(')', 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(parent, []).append(int(entry))
+    total = 0
+    pending = [root]
+    while pending:
+        pid = pending.pop()
+        pending.extend(children.get(pid, []))
+        try:
+            with open('/proc/{}/status'.format(pid)) as status:
+                for line in status:
+                    if line.startswith('VmRSS:'):
+                        total += int(line.split()[1]) * 1024
+        except OSError:
+            continue
+    return total
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    return values[min(int(round(p / 100 * (len(values) - 1))),
+                      len(values) - 1)]
+
+
+def run(text, corpus, backend, tor, idle_timeout, keep):
+    # Run TorSpider with one configuration until every url has been
+    # reported, or nothing has happened for idle_timeout seconds.
+    settings = parse_config(text)
+    directory = tempfile.mkdtemp(prefix='torspider-replay-')
+    write_config(os.path.join(directory, 'spider.cfg'), settings, backend,
+                 tor)
+    backend.reset(corpus.urls)
+    # Only the spider.cfg we wrote should configure the spiders.
+    env = {key: value for (key, value) in os.environ.items()
+           if key in ['PATH', 'HOME', 'LANG', 'LC_ALL', 'PYTHONPATH']}
+    before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    with open(os.path.join(directory, 'output.txt'), 'wb') as output:
+        process = subprocess.Popen([sys.executable, script], cwd=directory,
+                                   env=env, stdout=output,
+                                   stderr=subprocess.STDOUT)
+        peak_rss = 0
+        started = time.time()
+        while not backend.done() and process.poll() is None:
+            time.sleep(0.25)
+            peak_rss = max(peak_rss, tree_rss(process.pid) or 0)
+            (count, last_result) = backend.progress()
+            if time.time() - (last_result or started) > idle_timeout:
+                break
+        if process.poll() is None:
+            # Let the spiders finish up, as they would in a deploy.
+            process.send_signal(signal.SIGTERM)
+            try:
+                process.wait(120)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
+    after = resource.getrusage(resource.RUSAGE_CHILDREN)
+    if not peak_rss:
+        # Without /proc, settle for the largest single process.
+        peak_rss = (after.ru_maxrss * 1024) or None
+    with open(os.path.join(directory, 'output.txt'), 'rb') as output:
+        log = output.read().decode('utf-8', 'replace')
+    if keep:
+        print('Kept the run in {}'.format(directory))
+    else:
+        shutil.rmtree(directory, ignore_errors=True)
+    (count, last_result) = backend.progress()
+    latencies = backend.latencies()
+    elapsed = backend.elapsed()
+    cpu = (after.ru_utime - before.ru_utime) + (after.ru_stime - before.ru_stime)
+    return {
+        'urls': len(corpus.urls),
+        'results': count,
+        'seconds': elapsed,
+        'pages_per_second': count / elapsed if elapsed else 0,
+        'p50': percentile(latencies, 50),
+        'p99': percentile(latencies, 99),
+        'cpu_seconds': cpu,
+        'cpu_ms_per_page': cpu * 1000 / count if count else None,
+        'peak_rss_mb': peak_rss / 1048576 if peak_rss else None,
+        'exit_code': process.returncode,
+        'log': log
+    }
+
+
+def show(text, stats):
+    def number(value, form):
+        return form.format(value) if value is not None else '-'
+    print('{:<44} {:>6} {:>8} {:>7} {:>7} {:>8} {:>8} {:>8}'.format(
+        text[:44], '{}/{}'.format(stats['results'], stats['urls']),
+        number(stats['pages_per_second'], '{:.1f}'),
+        number(stats['p50'], '{:.2f}'), number(stats['p99'], '{:.2f}'),
+        number(stats['cpu_seconds'], '{:.1f}'),
+        number(stats['cpu_ms_per_page'], '{:.1f}'),
+        number(stats['peak_rss_mb'], '{:.0f}')))
+
+
+def compare(results, baseline, tolerance):
+    # Return a line for each way in which a configuration has got worse
+    # than in the baseline.
+    regressions = []
+    checks = [('pages_per_second', 'pages/s', -1), ('p99', 'p99', 1),
+              ('cpu_ms_per_page', 'CPU ms/page', 1),
+              ('peak_rss_mb', 'peak RSS MB', 1)]
+    for (text, stats) in results.items():
+        if text not in baseline:
+            continue
+        for (key, name, direction) in checks:
+            (now, then) = (stats.get(key), baseline[text].get(key))
+            if not now or not then:
+                continue
+            change = (now - then) / then
+            if change * direction > tolerance:
+                regressions.append('{}: {} went from {:.2f} to {:.2f}'.format(
+                    text, name, then, now))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark TorSpider against an offline replay of '
+                    'onion sites and the backend.')
+    parser.add_argument('-c', '--config', action='append',
+                        help='An engine configuration to run, as '
+                             'name=value,... (default: {})'.format(
+                                 '; '.join(default_configs)))
+    parser.add_argument('--urls', type=int, default=1000,
+                        help='How many urls to crawl (default: 1000)')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='The seed the corpus is generated from')
+    parser.add_argument('--pages',
+                        help='A directory of recorded HTML pages to serve '
+                             'instead of generated ones')
+    parser.add_argument('--idle-timeout', type=float, default=60,
+                        help='Give up after this many seconds without a '
+                             'result (default: 60)')
+    parser.add_argument('--save', help='Save the results to this JSON file')
+    parser.add_argument('--compare',
+                        help='Compare the results with those saved in this '
+                             'JSON file, and fail on any regression')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='How much worse than the baseline counts as a '
+                             'regression (default: 0.1)')
+    parser.add_argument('--keep', action='store_true',
+                        help="Keep each run's directory, with its output")
+    args = parser.parse_args()
+
+    corpus = Corpus(args.urls, args.seed, args.pages)
+    tor = FakeTor(corpus)
+    backend = Backend()
+    print('{:<44} {:>6} {:>8} {:>7} {:>7} {:>8} {:>8} {:>8}'.format(
+        'configuration', 'pages', 'pages/s', 'p50 s', 'p99 s', 'CPU s',
+        'CPU ms/p', 'RSS MB'))
+    results = {}
+    for text in args.config or default_configs:
+        try:
+            stats = run(text, corpus, backend, tor, args.idle_timeout,
+                        args.keep)
+        except ValueError as e:
+            print('{}: {}'.format(text, e))
+            sys.exit(1)
+        show(text, stats)
+        if stats['results'] < stats['urls']:
+            print('  Only {} of {} urls were reported. TorSpider said:'.format(
+                stats['results'], stats['urls']))
+            print('\n'.join('  ' + line for line in
+                            stats['log'].strip().splitlines()[-20:]))
+        del stats['log']
+        results[text] = stats
+
+    if args.save:
+        with open(args.save, 'w') as save_file:
+            json.dump(results, save_file, indent=2)
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+        regressions = compare(results, baseline, args.tolerance)
+        for line in regressions:
+            print('REGRESSION: ' + line)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
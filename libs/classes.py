@@ -1,18 +1,140 @@
-from datetime import date
+from datetime import date, datetime, timedelta
+from hashlib import sha1
+from enum import IntEnum
+import codecs
+import time
 import json
 
+# The newest version of the results we send the backend. See
+# SpiderURL.to_dict().
+schema_version = 2
+
+# Today's date, as reported in each result, and when it stops being today.
+today = [None, 0]
+
+
+def get_today():
+    # Return today's date, working it out at most once a day.
+    if time.time() >= today[1]:
+        day = date.today()
+        midnight = datetime.combine(day + timedelta(days=1), datetime.min.time())
+        today[:] = [day.isoformat(), midnight.timestamp()]
+    return today[0]
+
+
+class Fault(IntEnum):
+    # The faults we find with pages, other than HTTP status codes, which
+    # are reported as the status code itself.
+    TYPE = 1
+    TRUNCATED = 2
+    INVALID_SCHEMA = 3
+    INVALID_URL = 4
+    BAD_SSL = 5
+    REDIRECT = 6
+    MEMORY_ERROR = 7
+
+
+# How each fault was reported before the schema was versioned.
+fault_names = {
+    Fault.TYPE: 'type: {}',
+    Fault.TRUNCATED: 'truncated',
+    Fault.INVALID_SCHEMA: 'invalid schema',
+    Fault.INVALID_URL: 'invalid url',
+    Fault.BAD_SSL: 'Bad SSL',
+    Fault.REDIRECT: 'redirect',
+    Fault.MEMORY_ERROR: 'memory error'
+}
+
 
 class SpiderURL:
+    # The result of scanning a url. One of these is made for every url we
+    # scan, so it keeps its fields in slots rather than a dict. The fault is
+    # an HTTP status code or a Fault, with any detail, such as the content
+    # type for Fault.TYPE, in fault_detail.
+    __slots__ = ['new_urls', 'online', 'url', 'scan_date', 'last_node',
+                 'fault', 'fault_detail', 'title', 'form_dicts', 'hash',
+                 'etag', 'last_modified', 'fingerprint', 'redirect']
+
     def __init__(self):
         self.new_urls = []
         self.online = False
         self.url = None
-        self.scan_date = date.today().strftime('%Y-%m-%d')
+        self.scan_date = get_today()
         self.last_node = None
         self.fault = None
+        self.fault_detail = None
         self.title = None
         self.form_dicts = []
         self.hash = None
+        self.etag = None
+        self.last_modified = None
+        self.fingerprint = None
+        self.redirect = None
+
+    def to_dict(self, schema=1):
+        # Return the result in the given version of the backend's schema.
+        # Version 1 is the original: every field, with the fault as a
+        # string such as '404' or 'type: image'. Version 2 is marked with
+        # its version, reports the fault as a number, with any detail in
+        # fault_detail, and leaves out every field that is empty.
+        if schema == 1:
+            result = {}
+            for field in self.__slots__:
+                result[field] = getattr(self, field)
+            del result['fault_detail']
+            if self.fault in fault_names:
+                result['fault'] = fault_names[self.fault].format(
+                    self.fault_detail)
+            elif self.fault is not None:
+                result['fault'] = str(self.fault)
+            return result
+        result = {'schema': schema}
+        for field in self.__slots__:
+            value = getattr(self, field)
+            if value is not None and value != []:
+                result[field] = value
+        if self.fault is not None:
+            result['fault'] = int(self.fault)
+        return result
+
+    def to_json(self, schema=1):
+        return json.dumps(self.to_dict(schema))
+
+
+class PageReader:
+    # Reads a page's body a chunk at a time as it arrives, hashing it on the
+    # way, and stops once max_size bytes have been read so that a huge page
+    # can't exhaust the spider's memory. The page is only decoded if we ask
+    # for its text, so unchanged pages never need to be decoded at all.
+    def __init__(self, encoding='utf-8', max_size=None):
+        self.encoding = encoding
+        self.hasher = sha1()
+        self.chunks = []
+        self.size = 0
+        self.max_size = max_size
+        self.truncated = False
+
+    def feed(self, chunk):
+        # Add the next chunk of the page. Returns False once the page has
+        # reached max_size, at which point the rest should be discarded.
+        if self.max_size is not None and \
+                self.size + len(chunk) > self.max_size:
+            chunk = chunk[:self.max_size - self.size]
+            self.truncated = True
+        self.size += len(chunk)
+        self.hasher.update(chunk)
+        self.chunks.append(chunk)
+        return not self.truncated
+
+    def text(self):
+        # Return the page's text.
+        try:
+            codecs.lookup(self.encoding)
+        except LookupError:
+            # The server sent a charset we've never heard of.
+            self.encoding = 'utf-8'
+        return b''.join(self.chunks).decode(self.encoding, errors='replace')
 
-    def to_json(self):
-        return json.dumps(self.__dict__)
+    def hash(self):
+        # Return the sha1 hash of the page, as read so far.
+        return self.hasher.hexdigest()
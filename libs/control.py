@@ -0,0 +1,61 @@
+# Control of running spiders for TorSpider.
+
+import multiprocessing
+
+
+class Settings:
+    # The settings that can be changed while the spiders run. One is kept
+    # in the SpiderManager, shared by all of them.
+    def __init__(self):
+        self.values = {}
+
+    def update(self, values):
+        self.values.update(values)
+
+    def get(self):
+        return dict(self.values)
+
+
+class Control:
+    # Carries commands from the main process to the spiders: pause, resume
+    # and changes to settings. Whether the spiders are paused, and how many
+    # times the settings have changed, are kept in shared memory, so the
+    # spiders can check them on every url without a system call; only when
+    # the settings have actually changed does a spider ask the manager for
+    # them. Must be created before the spiders are forked.
+    def __init__(self, settings):
+        self.settings = settings
+        self.running = multiprocessing.Event()
+        self.running.set()
+        self.generation = multiprocessing.RawValue('L', 0)
+        # The generation of the settings this process last saw.
+        self.seen = 0
+
+    def pause(self):
+        self.running.clear()
+
+    def resume(self):
+        self.running.set()
+
+    def paused(self):
+        return not self.running.is_set()
+
+    def wait(self, timeout=None):
+        # Wait until we're resumed or timeout seconds pass. Returns whether
+        # we're running.
+        return self.running.wait(timeout)
+
+    def reload(self, values):
+        # Hand new settings to the spiders. Only the main process may call
+        # this.
+        self.settings.update(values)
+        self.generation.value += 1
+
+    def changes(self):
+        # Return all of the settings if they've changed since this process
+        # last looked, or None if they haven't.
+        generation = self.generation.value
+        if generation == self.seen:
+            return None
+        self.seen = generation
+        return self.settings.get()
@@ -0,0 +1,61 @@
+# Result batch encoders for TorSpider.
+
+import json
+
+try:
+    # orjson encodes JSON several times faster than json, but it's optional.
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    # msgpack's payloads are smaller than JSON's, but it's optional, and the
+    # backend has to accept it.
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+def encode_json(batch):
+    if orjson is not None:
+        try:
+            return orjson.dumps(batch)
+        except TypeError as e:
+            # orjson is stricter than json about what it will encode.
+            pass
+    return json.dumps(batch, separators=(',', ':')).encode('utf-8')
+
+
+def encode_msgpack(batch):
+    return msgpack.packb(batch)
+
+
+def decode_json(payload):
+    return json.loads(payload)
+
+
+def decode_msgpack(payload):
+    return msgpack.unpackb(payload)
+
+
+# The available encoders, as name: (encode, content type, spool file
+# extension).
+encoders = {
+    'json': (encode_json, 'application/json', '.json.gz')
+}
+if msgpack is not None:
+    encoders['msgpack'] = (encode_msgpack, 'application/msgpack',
+                           '.msgpack.gz')
+
+# The content type of the batches in each kind of spool file, including
+# those of encoders that aren't installed any more.
+spool_types = {
+    '.json.gz': 'application/json',
+    '.msgpack.gz': 'application/msgpack'
+}
+
+# How to read the batch back out of each kind of spool file, for the
+# encoders that are installed.
+decoders = {'.json.gz': decode_json}
+if msgpack is not None:
+    decoders['.msgpack.gz'] = decode_msgpack
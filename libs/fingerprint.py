@@ -0,0 +1,46 @@
+# Near-duplicate page detection for TorSpider.
+
+import re
+from hashlib import blake2b
+
+words = re.compile(r'\w+')
+
+
+def simhash(text, shingle_size=3):
+    # Return a 64-bit SimHash of the text: every run of shingle_size words
+    # votes on each bit of the result, so pages that share most of their
+    # text get fingerprints that differ in only a few bits, while a sha1 of
+    # the raw page changes completely over a single CSRF token or timestamp.
+    found = words.findall(text.lower())
+    if not found:
+        return 0
+    shingles = {' '.join(found[i:i + shingle_size])
+                for i in range(max(len(found) - shingle_size + 1, 1))}
+    bits = [format(int.from_bytes(
+                blake2b(shingle.encode('utf-8', 'surrogatepass'),
+                        digest_size=8).digest(), 'big'), '064b')
+            for shingle in shingles]
+    # Set each bit that most of the shingles have set.
+    half = len(bits) / 2
+    value = 0
+    for column in zip(*bits):
+        value = (value << 1) | (column.count('1') > half)
+    return value
+
+
+def distance(a, b):
+    # The number of bits in which two fingerprints differ.
+    return bin(a ^ b).count('1')
+
+
+def to_hex(value):
+    return '{:016x}'.format(value)
+
+
+def from_hex(value):
+    # Read a fingerprint as reported to the backend. Returns None for
+    # anything that isn't one.
+    try:
+        return int(value, 16)
+    except (TypeError, ValueError) as e:
+        return None
@@ -0,0 +1,82 @@
+# Tor and onion health for TorSpider.
+
+import time
+import threading
+from collections import OrderedDict
+from libs.torcontrol import TorControlError
+
+
+class TorHealth:
+    # Tells the spiders whether Tor is working. Whenever a url fails to
+    # connect we need to know whether the onion or Tor is to blame, but
+    # there's no sense in every spider checking after every failure: the
+    # controller is asked at most once every interval seconds, or every
+    # retry seconds while Tor is down, and all of the spiders share the
+    # answer. Tor is working once it's fully bootstrapped and has built a
+    # circuit.
+    def __init__(self, controller, interval=10, retry=5):
+        self.controller = controller
+        self.interval = interval
+        self.retry = retry
+        self.alive = False
+        self.reason = 'Not checked yet'
+        self.checked = 0
+        self.lock = threading.Lock()
+
+    def is_alive(self):
+        # Is Tor working?
+        return self.status()[0]
+
+    def status(self):
+        # Return whether Tor is working, and if not, why not.
+        with self.lock:
+            wait = self.interval if self.alive else self.retry
+            if time.time() - self.checked >= wait:
+                (self.alive, self.reason) = self.check()
+                self.checked = time.time()
+            return (self.alive, self.reason)
+
+    def check(self):
+        # Check whether Tor is working right now.
+        try:
+            (progress, circuits) = self.controller.status()
+        except (OSError, TorControlError) as e:
+            return (False, 'Cannot reach the Tor control port: {}'.format(e))
+        if progress < 100:
+            return (False, 'Tor is bootstrapping ({}%)'.format(progress))
+        if not circuits:
+            return (False, 'Tor has not built a circuit yet')
+        return (True, None)
+
+
+class OfflineCache:
+    # Remembers which onions we recently found to be offline, for ttl
+    # seconds, so that the rest of their urls can be reported offline
+    # without another attempt to connect. At most max_hosts are remembered.
+    def __init__(self, ttl=1800, max_hosts=100000):
+        self.ttl = ttl
+        self.max_hosts = max_hosts
+        # host: time it expires, oldest first
+        self.hosts = OrderedDict()
+        self.lock = threading.Lock()
+
+    def add(self, host):
+        # The onion at host is offline.
+        with self.lock:
+            self.hosts.pop(host, None)
+            self.hosts[host] = time.time() + self.ttl
+            self.__evict()
+
+    def is_offline(self, host):
+        # Was the onion at host recently found to be offline?
+        with self.lock:
+            self.__evict()
+            return host in self.hosts
+
+    def __evict(self):
+        now = time.time()
+        while self.hosts:
+            (host, expires) = next(iter(self.hosts.items()))
+            if expires > now and len(self.hosts) <= self.max_hosts:
+                break
+            self.hosts.popitem(last=False)
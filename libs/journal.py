@@ -0,0 +1,156 @@
+# Crash-safe crawl journal for TorSpider.
+
+import os
+import json
+import time
+import sqlite3
+import threading
+from libs.logging import logger
+
+
+class Journal:
+    # Records the urls each spider has leased and the results it hasn't yet
+    # handed to the backend, in an SQLite database in WAL mode, so work in
+    # flight survives a spider dying or the node restarting. Every row
+    # belongs to the process working on it. When a process exits, its rows
+    # are orphaned, and the other spiders claim orphaned urls before leasing
+    # more from the backend, and orphaned results to send off themselves.
+    # Orphaned urls older than max_age seconds are dropped, since by then
+    # the backend will have handed them out again. Each process opens its
+    # own connection on first use, and the main process must close its own
+    # before forking any spiders.
+    def __init__(self, path='journal/journal.db', max_age=3600):
+        self.path = path
+        self.max_age = max_age
+        self.pid = None
+        self.db = None
+        self.lock = threading.Lock()
+
+    def lease(self, leases):
+        # Record the (url, last_hash, last_fingerprint, validators) tuples
+        # this process has just leased.
+        now = time.time()
+        self.__run(lambda db: db.executemany(
+            'INSERT OR REPLACE INTO leases VALUES (?, ?, ?, ?)',
+            [(lease[0], json.dumps(lease), os.getpid(), now)
+             for lease in leases]))
+
+    def claim_leases(self, count):
+        # Take up to count orphaned leases to scan. Returns a list of
+        # (url, last_hash, last_fingerprint, validators) tuples.
+        def claim(db):
+            db.execute('DELETE FROM leases WHERE owner = 0 AND added < ?',
+                       (time.time() - self.max_age,))
+            rows = db.execute('SELECT url, lease FROM leases WHERE owner = 0 '
+                              'ORDER BY added LIMIT ?', (count,)).fetchall()
+            db.executemany('UPDATE leases SET owner = ? WHERE url = ?',
+                           [(os.getpid(), url) for (url, lease) in rows])
+            return [tuple(json.loads(lease)) for (url, lease) in rows]
+        return self.__run(claim) or []
+
+    def finish(self, url, result):
+        # Swap the lease on url for its result, as a dict. Returns the
+        # result's id, to acknowledge once the backend has it.
+        def finish(db):
+            db.execute('DELETE FROM leases WHERE url = ?', (url,))
+            return db.execute(
+                'INSERT INTO results (result, owner, added) VALUES (?, ?, ?)',
+                (json.dumps(result), os.getpid(), time.time())).lastrowid
+        return self.__run(finish)
+
+    def forget(self, url):
+        # Drop the lease on a url we won't be reporting back on.
+        self.__run(lambda db: db.execute(
+            'DELETE FROM leases WHERE url = ?', (url,)))
+
+    def claim_results(self, count):
+        # Take up to count orphaned results to send. Returns a list of
+        # (id, result) tuples.
+        def claim(db):
+            rows = db.execute('SELECT id, result FROM results WHERE owner = 0 '
+                              'ORDER BY id LIMIT ?', (count,)).fetchall()
+            db.executemany('UPDATE results SET owner = ? WHERE id = ?',
+                           [(os.getpid(), id) for (id, result) in rows])
+            return [(id, json.loads(result)) for (id, result) in rows]
+        return self.__run(claim) or []
+
+    def acknowledge(self, ids):
+        # The backend has the results with these ids, or they've been
+        # spooled, so we can forget about them.
+        self.__run(lambda db: db.executemany(
+            'DELETE FROM results WHERE id = ?', [(id,) for id in ids]))
+
+    def orphan(self, pid=None):
+        # Give up the rows of the process with the given pid, or of every
+        # process, for others to claim.
+        def orphan(db):
+            if pid is None:
+                db.execute('UPDATE leases SET owner = 0')
+                db.execute('UPDATE results SET owner = 0')
+            else:
+                db.execute('UPDATE leases SET owner = 0 WHERE owner = ?',
+                           (pid,))
+                db.execute('UPDATE results SET owner = 0 WHERE owner = ?',
+                           (pid,))
+        self.__run(orphan)
+
+    def pending(self):
+        # Return how many leases and results the journal holds.
+        def count(db):
+            return tuple(db.execute('SELECT COUNT(*) FROM {}'.format(table))
+                         .fetchone()[0] for table in ['leases', 'results'])
+        return self.__run(count) or (0, 0)
+
+    def close(self):
+        # Close this process's connection. SQLite connections mustn't be
+        # carried across a fork, so this has to happen before forking.
+        with self.lock:
+            if self.db is not None and self.pid == os.getpid():
+                self.db.close()
+            self.db = None
+            self.pid = None
+
+    def __run(self, func):
+        # Call func with the database, in a single transaction. Anything
+        # that goes wrong is logged, and only costs us the journal entry.
+        with self.lock:
+            try:
+                db = self.__connect()
+                db.execute('BEGIN IMMEDIATE')
+                try:
+                    result = func(db)
+                except BaseException:
+                    db.execute('ROLLBACK')
+                    raise
+                db.execute('COMMIT')
+                return result
+            except (sqlite3.Error, OSError) as e:
+                logger.log('Journal error: {}', 'error', e)
+                return None
+
+    def __connect(self):
+        # Connections can't be shared with forked processes, so each
+        # process opens its own.
+        if self.pid != os.getpid():
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self.db = sqlite3.connect(self.path, timeout=30,
+                                      isolation_level=None,
+                                      check_same_thread=False)
+            # With write-ahead logging, commits don't wait on the disk and
+            # readers don't block writers; a crashed process loses nothing.
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('PRAGMA synchronous=NORMAL')
+            self.db.execute('CREATE TABLE IF NOT EXISTS leases '
+                            '(url TEXT PRIMARY KEY, lease TEXT, '
+                            'owner INTEGER, added REAL)')
+            self.db.execute('CREATE TABLE IF NOT EXISTS results '
+                            '(id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                            'result TEXT, owner INTEGER, added REAL)')
+            self.db.execute('CREATE INDEX IF NOT EXISTS leases_owner '
+                            'ON leases (owner, added)')
+            self.db.execute('CREATE INDEX IF NOT EXISTS results_owner '
+                            'ON results (owner, id)')
+            self.pid = os.getpid()
+        return self.db
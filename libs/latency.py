@@ -0,0 +1,71 @@
+# Per-onion latency tracking for TorSpider.
+
+import threading
+from collections import OrderedDict, deque
+
+
+class LatencyTracker:
+    # Learns how quickly each onion responds, from how long it took to get
+    # the headers of its recent responses, and sets the timeouts for the next
+    # request to match: factor times the given percentile of those times,
+    # kept between min_timeout and max_timeout. Onions we know nothing about
+    # get max_timeout, and onions that have timed out fail_after times in a
+    # row only get fail_timeout, so dead services fail fast.
+    def __init__(self, samples=20, percentile=95, factor=3, min_timeout=10,
+                 max_timeout=30, fail_after=3, fail_timeout=5,
+                 max_hosts=100000):
+        self.samples = samples
+        self.percentile = percentile
+        self.factor = factor
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.fail_after = fail_after
+        self.fail_timeout = fail_timeout
+        self.max_hosts = max_hosts
+        # host: [recent response times, timeouts in a row]
+        self.hosts = OrderedDict()
+        self.lock = threading.Lock()
+
+    def timeout(self, host):
+        # How long to wait on the next request to host, in seconds.
+        with self.lock:
+            state = self.hosts.get(host)
+            if state is None:
+                return self.max_timeout
+            (times, timeouts) = state
+            if timeouts >= self.fail_after:
+                return self.fail_timeout
+            if not times:
+                return self.max_timeout
+            ordered = sorted(times)
+            index = min(len(ordered) * self.percentile // 100, len(ordered) - 1)
+            return min(max(ordered[index] * self.factor, self.min_timeout),
+                       self.max_timeout)
+
+    def record(self, host, latency):
+        # The request to host got a response after latency seconds.
+        with self.lock:
+            state = self.__state(host)
+            state[0].append(latency)
+            state[1] = 0
+
+    def record_timeout(self, host):
+        # The request to host timed out.
+        with self.lock:
+            self.__state(host)[1] += 1
+
+    def set_bounds(self, min_timeout, max_timeout):
+        # Change the shortest and longest timeouts we'll give any onion.
+        with self.lock:
+            self.min_timeout = min_timeout
+            self.max_timeout = max_timeout
+
+    def __state(self, host):
+        if host in self.hosts:
+            self.hosts.move_to_end(host)
+        else:
+            self.hosts[host] = [deque(maxlen=self.samples), 0]
+            if len(self.hosts) > self.max_hosts:
+                # Forget about the onion we heard from least recently.
+                self.hosts.popitem(last=False)
+        return self.hosts[host]
@@ -2,19 +2,65 @@
 
 import os
 import sys
+import json
+import atexit
 import logging
 import configparser
-from multiprocessing import current_process
-from logging.handlers import TimedRotatingFileHandler
+import multiprocessing
+from logging.handlers import (QueueHandler, QueueListener,
+                              TimedRotatingFileHandler)
+
+# Our log levels, by name.
+levels = {
+    'debug': logging.DEBUG,
+    'info': logging.INFO,
+    'warning': logging.WARNING,
+    'error': logging.ERROR,
+    'critical': logging.CRITICAL
+}
+
+
+class Message:
+    # A log message that isn't put together until something actually
+    # writes it, so lines that are filtered out cost next to nothing.
+    __slots__ = ['line', 'args']
+
+    def __init__(self, line, args):
+        self.line = line
+        self.args = args
+
+    def __str__(self):
+        line = self.line.format(*self.args) if self.args else self.line
+        return ' '.join(line.split())  # Remove unnecessary whitespace.
+
+
+class JsonFormatter(logging.Formatter):
+    # Writes each record as a line of JSON.
+    def format(self, record):
+        return json.dumps({
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'process': record.processName,
+            'message': record.getMessage()
+        })
+
 
 class Logger:
+    # Every process, including the spiders forked from this one, hands its
+    # log records to a queue. A single listener thread in the process that
+    # created the logger writes them out, so only one process ever touches
+    # the log file.
     def __init__(self):
         script_dir = os.path.dirname(os.path.abspath(sys.argv[0]))
         loglevel = 'INFO'
         log_to_console = False
+        log_format = 'text'
         try:
             config = configparser.ConfigParser()
             config.read('spider.cfg')
+            log_format = os.environ.get('LogFormat', None)
+            if not log_format:
+                log_format = config['LOGGING'].get('format', 'text')
             log_to_console = os.environ.get('LogToConsole', None)
             if not log_to_console:
                 log_to_console = config['TorSpider'].getboolean('LogToConsole')
@@ -23,42 +69,81 @@ class Logger:
                 loglevel = config['LOGGING'].get('loglevel')
         except Exception as e:
             pass
-        self.logger = self.__get_logger(loglevel, script_dir, log_to_console)
+        self.queue = multiprocessing.Queue()
+        self.listener = QueueListener(
+            self.queue, *self.__get_handlers(script_dir, log_to_console,
+                                             log_format))
+        self.listener.start()
+        self.pid = os.getpid()
+        atexit.register(self.stop)
+        self.logger = self.__get_logger(loglevel, self.queue)
 
     @staticmethod
-    def __get_logger(loglevel, script_dir, log_to_console):
-        formatter = logging.Formatter(
-                "%(asctime)s - %(levelname)s - %(message)s")
-        my_logger = logging.getLogger('TorSpider')
+    def __get_handlers(script_dir, log_to_console, log_format):
+        if log_format == 'json':
+            formatter = JsonFormatter()
+        else:
+            formatter = logging.Formatter(
+                "%(asctime)s - %(levelname)s - %(processName)s: %(message)s")
         os.makedirs(os.path.join(script_dir, 'logs'), exist_ok=True)
         filehandler = TimedRotatingFileHandler(
             os.path.join(script_dir, 'logs', 'TorSpider.log'),
             when='midnight', backupCount=7, interval=1)
         filehandler.setFormatter(formatter)
-        my_logger.addHandler(filehandler)
+        handlers = [filehandler]
         if log_to_console:
             consolehandler = logging.StreamHandler()
             consolehandler.setFormatter(formatter)
-            my_logger.addHandler(consolehandler)
+            handlers.append(consolehandler)
+        return handlers
+
+    @staticmethod
+    def __get_logger(loglevel, queue):
+        my_logger = logging.getLogger('TorSpider')
+        my_logger.addHandler(QueueHandler(queue))
+        my_logger.propagate = False
         my_logger.setLevel(logging.getLevelName(loglevel))
         logging.getLogger("urllib3").setLevel(logging.WARNING)
         return my_logger
 
+    def log(self, line, level, *args):
+        # Log the line at the given level. Any args are formatted into the
+        # line with str.format(), but only if the line is actually logged.
+        levelno = levels.get(level.lower())
+        if levelno is None or not self.logger.isEnabledFor(levelno):
+            return
+        self.logger.log(levelno, Message(line, args))
+
+    def exception(self, line, *args):
+        # Log the line as an error, along with the traceback of the
+        # exception being handled.
+        if self.logger.isEnabledFor(logging.ERROR):
+            self.logger.error(Message(line, args), exc_info=True)
+
+    def set_level(self, level):
+        # Change which lines this process logs, by level name.
+        levelno = levels.get(level.lower())
+        if levelno is None:
+            raise ValueError('Unknown log level: {}'.format(level))
+        self.logger.setLevel(levelno)
+
+    def close(self):
+        # Stop logging from this process, once everything it has logged is
+        # safely in the queue. A process killed while writing to the queue
+        # could leave it locked or corrupt for every other process, so this
+        # must come first.
+        for handler in list(self.logger.handlers):
+            if isinstance(handler, QueueHandler):
+                self.logger.removeHandler(handler)
+                handler.close()
+        self.queue.close()
+        self.queue.join_thread()
 
-    def log(self, line, level):
-        message = '{}: {}'.format(
-            current_process().name,
-            line)
-        message = ' '.join(message.split())  # Remove unnecessary whitespace.
-        if level.lower() == 'debug':
-            self.logger.debug(message)
-        elif level.lower() == 'info':
-            self.logger.info(message)
-        elif level.lower() == 'warning':
-            self.logger.warning(message)
-        elif level.lower() == 'error':
-            self.logger.error(message)
-        elif level.lower() == 'critical':
-            self.logger.critical(message)
+    def stop(self):
+        # Write out anything still queued. Only the process that created
+        # the logger runs the listener.
+        if os.getpid() == self.pid and self.listener is not None:
+            self.listener.stop()
+            self.listener = None
 
 logger = Logger()
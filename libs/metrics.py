@@ -0,0 +1,242 @@
+# Live metrics for TorSpider.
+
+import os
+import time
+import threading
+from bisect import bisect_left
+from multiprocessing import current_process
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from libs.logging import logger
+
+# Each metric we keep, as name: (type, help, histogram buckets).
+definitions = {
+    'torspider_pages_total': (
+        'counter', 'Urls scanned, by whether they were online.', None),
+    'torspider_responses_total': (
+        'counter', 'Responses received, by HTTP status code.', None),
+    'torspider_faults_total': (
+        'counter', 'Urls reported with a fault, by fault.', None),
+    'torspider_bytes_total': (
+        'counter', 'Bytes of page bodies downloaded.', None),
+    'torspider_request_seconds': (
+        'histogram', 'Time until the response headers arrived, by method.',
+        (0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60)),
+    'torspider_parse_seconds': (
+        'histogram', 'Time spent parsing each page.',
+        (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1)),
+    'torspider_idle_seconds_total': (
+        'counter', 'Time workers spent waiting for urls to scan, by worker.',
+        None),
+    'torspider_submit_queue': (
+        'gauge', 'Results waiting to be sent to the backend, by worker.',
+        None),
+}
+
+# The metrics kept for each worker. They're labelled with the supervisor's
+# slot for the worker rather than its process, since processes come and go.
+per_worker = ['torspider_idle_seconds_total', 'torspider_submit_queue']
+
+
+class Metrics:
+    # Counts what this process is up to. Updates are kept locally, and a
+    # background thread hands them over to the shared MetricsCollector every
+    # interval seconds, so recording a metric never waits on another process.
+    # Until connect() is called, nothing is recorded at all.
+    def __init__(self, interval=5):
+        self.interval = interval
+        self.collector = None
+        self.pid = None
+        self.thread = None
+        self.lock = threading.Lock()
+        self.values = {}
+        self.gauges = {}
+        # This process's slot, if the supervisor gave it one.
+        self.worker = None
+
+    def connect(self, collector):
+        # Start sending our metrics to the collector.
+        self.collector = collector
+
+    def inc(self, name, value=1, **labels):
+        # Add value to a counter.
+        if self.collector is None:
+            return
+        key = metric_key(name, self.__labels(name, labels))
+        with self.lock:
+            self.__start()
+            self.values[key] = self.values.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        # Add a sample to a histogram.
+        if self.collector is None:
+            return
+        buckets = definitions[name][2]
+        key = metric_key(name, labels)
+        with self.lock:
+            self.__start()
+            counts = self.values.get(key)
+            if counts is None:
+                # A count for each bucket, of the samples no bigger than its
+                # bound but bigger than the last one's, then the sum and the
+                # total count.
+                counts = self.values[key] = [0] * (len(buckets) + 2)
+            n = bisect_left(buckets, value)
+            if n < len(buckets):
+                counts[n] += 1
+            counts[-2] += value
+            counts[-1] += 1
+
+    def set(self, name, value, **labels):
+        # Set a gauge.
+        if self.collector is None:
+            return
+        key = metric_key(name, self.__labels(name, labels))
+        with self.lock:
+            self.__start()
+            self.gauges[key] = value
+
+    def flush(self):
+        # Hand everything recorded since the last flush to the collector.
+        with self.lock:
+            (values, gauges) = (self.values, self.gauges)
+            (self.values, self.gauges) = ({}, {})
+        if not values and not gauges:
+            return
+        try:
+            self.collector.merge(values, gauges)
+        except Exception as e:
+            logger.log('Could not send metrics: {}', 'error', e)
+
+    def __labels(self, name, labels):
+        if name in per_worker:
+            labels['worker'] = (current_process().name if self.worker is None
+                                else self.worker)
+        return labels
+
+    def __start(self):
+        # Start the flushing thread in each process that records anything.
+        # Anything recorded before this process was forked isn't ours.
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            (self.values, self.gauges) = ({}, {})
+            self.thread = threading.Thread(target=self.__run, daemon=True)
+            self.thread.start()
+
+    def __run(self):
+        while True:
+            time.sleep(self.interval)
+            self.flush()
+
+
+class MetricsCollector:
+    # Adds up the metrics of all of the spiders. One collector is shared by
+    # all of them.
+    def __init__(self):
+        self.values = {}
+        self.gauges = {}
+        self.lock = threading.Lock()
+
+    def merge(self, values, gauges):
+        # Add a process's latest counts.
+        with self.lock:
+            for (key, value) in values.items():
+                if isinstance(value, list):
+                    totals = self.values.setdefault(key, [0] * len(value))
+                    for n, count in enumerate(value):
+                        totals[n] += count
+                else:
+                    self.values[key] = self.values.get(key, 0) + value
+            self.gauges.update(gauges)
+
+    def forget(self, worker):
+        # Drop the gauges of a worker that has stopped, since nothing will
+        # update them again.
+        with self.lock:
+            for key in list(self.gauges.keys()):
+                if ('worker', str(worker)) in key[1]:
+                    del self.gauges[key]
+
+    def total(self, name):
+        # Return a counter's total over all of its labels, or for a
+        # histogram, the [sum, count] of all of its samples.
+        with self.lock:
+            found = [value for ((sample_name, labels), value)
+                     in self.values.items() if sample_name == name]
+        if definitions[name][0] == 'histogram':
+            return [sum(value[-2] for value in found),
+                    sum(value[-1] for value in found)]
+        return sum(found)
+
+    def render(self):
+        # Return the metrics in the Prometheus text format.
+        with self.lock:
+            samples = dict(self.values)
+            samples.update(self.gauges)
+            samples = sorted(samples.items())
+        lines = []
+        for (name, (kind, description, buckets)) in sorted(definitions.items()):
+            lines.append('# HELP {} {}'.format(name, description))
+            lines.append('# TYPE {} {}'.format(name, kind))
+            for ((sample_name, labels), value) in samples:
+                if sample_name != name:
+                    continue
+                if kind != 'histogram':
+                    lines.append('{}{} {}'.format(name, format_labels(labels),
+                                                  value))
+                    continue
+                cumulative = 0
+                for (bound, count) in zip(buckets, value):
+                    cumulative += count
+                    lines.append('{}_bucket{} {}'.format(
+                        name, format_labels(labels + (('le', bound),)),
+                        cumulative))
+                lines.append('{}_bucket{} {}'.format(
+                    name, format_labels(labels + (('le', '+Inf'),)),
+                    value[-1]))
+                lines.append('{}_sum{} {}'.format(name, format_labels(labels),
+                                                 value[-2]))
+                lines.append('{}_count{} {}'.format(
+                    name, format_labels(labels), value[-1]))
+        return '\n'.join(lines) + '\n'
+
+
+def metric_key(name, labels):
+    # Identify a metric by its name and the values of its labels.
+    return (name, tuple(sorted((key, str(value))
+                               for (key, value) in labels.items())))
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{{{}}}'.format(','.join(
+        '{}="{}"'.format(key, str(value).replace('\\', '\\\\')
+                         .replace('"', '\\"').replace('\n', '\\n'))
+        for (key, value) in labels))
+
+
+def serve_metrics(collector, host='127.0.0.1', port=9405):
+    # Serve the collector's metrics over HTTP at /metrics, from a background
+    # thread. Returns the server.
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = collector.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type',
+                             'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+metrics = Metrics()
@@ -0,0 +1,47 @@
+# Onion address validation for TorSpider.
+
+import re
+import base64
+from hashlib import sha3_256
+from functools import lru_cache
+
+# Matches a canonical http(s) url to an onion, capturing the onion's
+# address: 56 base32 characters for version 3, or 16 for version 2. Any
+# subdomains are allowed, but not a further domain after the '.onion', as
+# used by onion redirectors.
+onion_url = re.compile(r'https?://(?:[^/?#@]*@)?(?:[a-z0-9-]+\.)*'
+                       r'([a-z2-7]{56}|[a-z2-7]{16})\.onion(?::\d+)?(?:[/?]|$)')
+
+
+@lru_cache(maxsize=65536)
+def onion_version(address):
+    # Return the version of the onion address, without its '.onion': 3 for
+    # a valid version 3 address, 2 for a version 2 address, or None if it
+    # isn't a valid onion address at all. Version 3 addresses hold the
+    # service's public key, a checksum and the version, so we can tell
+    # whether they've been mangled. Version 2 addresses carry no checksum.
+    if len(address) == 16:
+        return 2 if re.fullmatch('[a-z2-7]{16}', address) else None
+    if len(address) != 56:
+        return None
+    try:
+        decoded = base64.b32decode(address.upper())
+    except ValueError as e:
+        return None
+    (pubkey, checksum, version) = (decoded[:32], decoded[32:34], decoded[34:])
+    if version != b'\x03':
+        return None
+    expected = sha3_256(b'.onion checksum' + pubkey + version).digest()[:2]
+    return 3 if checksum == expected else None
+
+
+def onion_urls(urls, versions=(3,)):
+    # Return those of the canonical urls that point at an onion of one of
+    # the given versions, in order.
+    match = onion_url.match
+    valid = []
+    for url in urls:
+        found = match(url)
+        if found and onion_version(found.group(1)) in versions:
+            valid.append(url)
+    return valid
@@ -2,8 +2,70 @@
 
 from libs.functions import *
 from libs.logging import logger
+from libs.fingerprint import simhash
 from html.parser import HTMLParser
-from urllib.parse import urlsplit, urlunsplit
+from libs.urls import join_url
+
+try:
+    # lxml's C tokenizer is much faster than html.parser, but it's optional.
+    from lxml import etree
+except ImportError:
+    etree = None
+
+'''---[ GLOBAL VARIABLES ]---'''
+
+# The backend used to tokenize HTML. See use_backend().
+backend = 'html.parser'
+
+# Pages that every backend must parse exactly as html.parser does before we
+# let it loose on the darknet.
+conformance_url = 'http://conformance.onion/dir/page.html'
+conformance_pages = [
+    '<html><head><title> The &amp; Title </title></head><body>'
+    '<a href="http://other.onion/">Other</a> <a href="/root">Root</a>'
+    '<a href="page2.html">Page 2</a> <a href="./here">Here</a>'
+    '<a href="../up">Up</a> <a href="abc.onion/path">Bare</a>'
+    '<a href="https://clearnet.com/">Clearnet</a> <a>No href</a>'
+    '<a href="http://redirect.onion.to/">Redirector</a></body></html>',
+    '<!DOCTYPE html><html><head><meta charset="utf-8">'
+    '<title>First</title><script>var x = "<title>nope</title>";</script>'
+    '</head><body><!-- <a href="/commented">x</a> -->'
+    '<p>Text &lt;b&gt; <b>bold</b></p><svg><title>Last</title></svg>'
+    '</body></html>',
+    '<form action="/login" method="post" target="_self">'
+    '<input type="text" name="user" value="me">'
+    '<input type="password" name="pass"><input type="email" name="mail">'
+    '<input type="search" name="q"><input type="tel" name="tel">'
+    '<input type="url" name="site"><input type="date" name="d">'
+    '<input type="datetime-local" name="dt"><input type="month" name="m">'
+    '<input type="number" name="n"><input type="range" name="r">'
+    '<input type="time" name="t"><input type="week" name="w">'
+    '<input type="checkbox" name="c" value="1">'
+    '<input type="checkbox" name="c" value="2">'
+    '<input type="radio" name="rb" value="a">'
+    '<input type="radio" name="rb" value="b">'
+    '<input type="submit" name="go" value="Go">'
+    '<select name="s"><option value="x">X</option>'
+    '<option value="y">Y</option></select>'
+    '<textarea name="ta">  Some text  </textarea></form>',
+    '<form action="search.php"><input type="text" name="q"/></form>'
+    '<form><input type="hidden" name="h" value="v">'
+    '<select name="empty"></select></form>'
+    '<a href="/after">After</a>',
+    '<p>Unclosed <a href="/one">one<a href="/two">two',
+    # lxml rebuilds the tree as a browser would, so it drops nested forms,
+    # closes unclosed ones early, ends comments at the wrong place and keeps
+    # the first of two attributes where html.parser keeps the last.
+    '<form action="/outer"><input type="text" name="a">'
+    '<form action="/inner"><input type="text" name="b"></form>'
+    '<input type="text" name="c"></form>',
+    '<div><form action="/unclosed"><input type="text" name="a"></div>'
+    '<input type="text" name="b">',
+    '<!-- unclosed <a href="/in">x</a> -- > <a href="/out">y</a> -->'
+    '<a href="/after">z</a>',
+    '<a href="/first" href="/second">Twice</a>',
+    '',
+]
 
 '''---[ CLASSES ]---'''
 
@@ -71,6 +133,7 @@ class FormParser(HTMLParser):
         self.forms = []
         self.text_area = False
         self.selecting = False
+        self.select_name = ''
         self.reset_fields()
 
     def handle_starttag(self, tag, attrs):
@@ -201,64 +264,202 @@ class FormParser(HTMLParser):
         self.weeks = []
 
 
+class PageParser(FormParser):
+    # Parse given HTML for its title, a.href links and forms all at once, so
+    # that each page only needs to be tokenized a single time. The results
+    # are the same as those of ParseTitle, ParseLinks and FormParser. If
+    # text is set, the page's visible text is gathered in the same pass.
+    def __init__(self, text=False):
+        FormParser.__init__(self)
+        self.output_list = []
+        self.match = False
+        self.title = ''
+        self.text = [] if text else None
+        self.hidden = False
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'a':
+            self.output_list.append(dict(attrs).get('href'))
+        self.match = True if tag == 'title' else False
+        if tag in ['script', 'style']:
+            self.hidden = True
+        FormParser.handle_starttag(self, tag, attrs)
+
+    def handle_endtag(self, tag):
+        if tag in ['script', 'style']:
+            self.hidden = False
+        FormParser.handle_endtag(self, tag)
+
+    def handle_data(self, data):
+        if self.match:
+            self.title = data
+            self.match = False
+        if self.text is not None and not self.hidden:
+            self.text.append(data)
+        FormParser.handle_data(self, data)
+
+
+class LxmlTarget:
+    # Passes the tags and text found by lxml's tokenizer on to one of the
+    # HTMLParser subclasses above, in the form html.parser would have, so
+    # that every backend shares the same parsing logic.
+    def __init__(self, parse):
+        self.parse = parse
+        self.text = []
+
+    def flush(self):
+        # html.parser hands over all the text between two tags at once.
+        if self.text:
+            self.parse.handle_data(''.join(self.text))
+            self.text = []
+
+    def start(self, tag, attrib):
+        self.flush()
+        self.parse.handle_starttag(tag, list(attrib.items()))
+
+    def end(self, tag):
+        self.flush()
+        self.parse.handle_endtag(tag)
+
+    def data(self, data):
+        self.text.append(data)
+
+    def comment(self, text):
+        self.flush()
+
+    def doctype(self, *args):
+        self.flush()
+
+    def pi(self, *args):
+        self.flush()
+
+    def close(self):
+        self.flush()
+
+
 '''---[ FUNCTIONS ]---'''
 
 
-def get_forms(data):
+def feed_html_parser(parse, data):
+    # Tokenize the HTML with Python's own html.parser.
+    parse.feed(data)
+
+
+def feed_lxml(parse, data):
+    # Tokenize the HTML with lxml.
+    if not data:
+        return
+    lxml_parser = etree.HTMLParser(target=LxmlTarget(parse))
+    lxml_parser.feed(data)
+    lxml_parser.close()
+
+
+# The available backends, by name.
+backends = {'html.parser': feed_html_parser}
+if etree is not None:
+    backends['lxml'] = feed_lxml
+
+
+def feed(parse, data, using=None):
+    # Feed the HTML to the given parser, using the named backend, or the
+    # current one.
+    backends[using or backend](parse, data)
+
+
+def check_backend(name):
+    # Parse the conformance pages with the named backend, and return a list
+    # of those it didn't parse exactly as html.parser does.
+    failures = []
+    for page in conformance_pages:
+        results = []
+        for using in ['html.parser', name]:
+            (title, links, forms, fingerprint) = get_page(
+                page, conformance_url, True, using)
+            results.append((
+                get_title(page, using),
+                sorted(get_links(page, conformance_url, using)),
+                get_forms(page, using),
+                title, forms, fingerprint))
+        if results[0] != results[1]:
+            failures.append(page)
+    return failures
+
+
+def use_backend(name='auto'):
+    # Choose the backend to tokenize HTML with, and return its name. With
+    # 'auto', the fastest installed backend that parses the conformance
+    # pages correctly is chosen. A backend that doesn't, whether chosen by
+    # name or not, would change what we report, so html.parser is used
+    # instead.
+    global backend
+    if name != 'auto' and name not in backends:
+        raise ValueError('Unknown or unavailable parser: {}'.format(name))
+    backend = 'html.parser'
+    for candidate in ['lxml'] if name == 'auto' else [name]:
+        if candidate == backend or candidate not in backends:
+            continue
+        failures = check_backend(candidate)
+        if failures:
+            logger.log('The {} backend failed {} conformance pages; using '
+                       'html.parser instead.', 'warning', candidate,
+                       len(failures))
+        else:
+            backend = candidate
+            break
+    return backend
+
+
+def get_forms(data, using=None):
     # Get the data from all forms on the page.
     parse = FormParser()
-    parse.feed(data)
+    feed(parse, data, using)
     return parse.forms
 
 
-def get_links(data, url):
-    logger.log("Getting links for url: {}".format(url), 'debug')
+def get_links(data, url, using=None):
     # Given HTML input, return a list of all unique links.
     parse = ParseLinks()
-    parse.feed(data)
+    feed(parse, data, using)
+    return resolve_links(parse.output_list, url)
+
+
+def get_page(data, url, fingerprint=False, using=None):
+    # Given HTML input, return the title of the page, a list of all unique
+    # links, the data from all forms on the page and, if asked for, the
+    # SimHash of its visible text, all in a single pass. Each function
+    # parses with the current backend unless another is named.
+    parse = PageParser(fingerprint)
+    feed(parse, data, using)
+    return (parse.title.strip(), resolve_links(parse.output_list, url),
+            parse.forms, simhash(' '.join(parse.text)) if fingerprint else None)
+
+
+def resolve_links(hrefs, url):
+    logger.log("Getting links for url: {}", 'debug', url)
+    # Given a page's a.href links, return a list of all unique links to web
+    # pages, in canonical form.
     links = []
-    domain = urlsplit(url)[1]
-    for link in parse.output_list:
+    for link in hrefs:
         try:
             if link is None:
                 # Skip empty links.
                 continue
-            # Remove any references to the current directory. ('./')
-            while './' in link:
-                link = link.replace('./', '')
-            # Split the link into its component parts.
-            (scheme, netloc, path, query, fragment) = urlsplit(link)
-            # Fill in empty schemes.
-            scheme = 'http' if scheme is '' else scheme
-            # Fill in empty paths.
-            path = '/' if path is '' else path
-            if netloc is '' and '.onion' in path.split('/')[0]:
-                # The urlparser mistook the domain as part of the path.
-                netloc = path.split('/')[0]
-                try:
-                    path = '/'.join(path.split('/')[1:])
-                except Exception as e:
-                    path = '/'
-            # Fill in empty domains.
-            netloc = domain if netloc is '' else netloc
-            fragment = ''
-            if '.onion' not in netloc or '.onion.' in netloc:
-                # We are only interested in links to other .onion domains,
-                # and we don't want to include links to onion redirectors.
+            # Resolve the link against the page's url, in canonical form.
+            link = join_url(url, link)
+            if link is None:
+                # Not a link to a web page.
                 continue
-            links.append(urlunsplit(
-                (scheme, netloc, path, query, fragment)))
+            links.append(link)
         except Exception as e:
-            logger.log('Link exception: {} -- {}'.format(e, link), 'error')
+            logger.log('Link exception: {} -- {}', 'error', e, link)
     # Make sure we don't return any duplicates!
     unique_links = unique(links)
-    logger.log("Found {} links in url: {}".format(
-            len(unique_links), url), 'debug')
+    logger.log("Found {} links in url: {}", 'debug', len(unique_links), url)
     return unique_links
 
 
-def get_title(data):
+def get_title(data, using=None):
     # Given HTML input, return the title of the page.
     parse = ParseTitle()
-    parse.feed(data)
+    feed(parse, data, using)
     return parse.title.strip()
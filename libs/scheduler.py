@@ -0,0 +1,72 @@
+# Per-onion request scheduling for TorSpider.
+
+import time
+import threading
+
+
+class HostScheduler:
+    # Keeps the spiders from hammering any one hidden service. Each onion is
+    # allowed at most max_in_flight requests at once, must wait min_delay
+    # seconds between requests, and has a token bucket that refills at rate
+    # requests per second, holding up to burst tokens. One scheduler is
+    # shared by all of the spiders, so these limits hold across processes.
+    def __init__(self, max_in_flight=4, min_delay=0.5, rate=2.0, burst=10,
+                 retry=1.0, slot_timeout=300, idle_timeout=600):
+        self.max_in_flight = max_in_flight
+        self.min_delay = min_delay
+        self.rate = rate
+        self.burst = burst
+        self.retry = retry
+        self.slot_timeout = slot_timeout
+        self.idle_timeout = idle_timeout
+        self.hosts = {}
+        self.lock = threading.Lock()
+        self.last_prune = time.time()
+
+    def acquire(self, host):
+        # Ask to send a request to host. Returns 0 if we may go ahead, in
+        # which case release() must be called once the request is done, or
+        # otherwise the number of seconds to wait before asking again.
+        with self.lock:
+            now = time.time()
+            self.__prune(now)
+            if host not in self.hosts:
+                # [start times of requests in flight, last start, tokens,
+                #  time the tokens were last topped up]
+                self.hosts[host] = [[], 0.0, self.burst, now]
+            state = self.hosts[host]
+            (in_flight, last_start, tokens, updated) = state
+            # Forget about requests that should long since have finished;
+            # their spider has probably died.
+            in_flight[:] = [started for started in in_flight
+                            if now - started < self.slot_timeout]
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            state[2:] = [tokens, now]
+            if len(in_flight) >= self.max_in_flight:
+                return self.retry
+            wait = last_start + self.min_delay - now
+            if tokens < 1:
+                wait = max(wait, (1 - tokens) / self.rate)
+            if wait > 0:
+                return wait
+            in_flight.append(now)
+            state[1] = now
+            state[2] = tokens - 1
+            return 0
+
+    def release(self, host):
+        # The request to host has finished.
+        with self.lock:
+            state = self.hosts.get(host)
+            if state and state[0]:
+                state[0].pop(0)
+
+    def __prune(self, now):
+        # Every so often, forget about onions we haven't visited in a while.
+        if now - self.last_prune < self.idle_timeout:
+            return
+        self.last_prune = now
+        for host in list(self.hosts.keys()):
+            state = self.hosts[host]
+            if not state[0] and now - state[1] > self.idle_timeout:
+                del self.hosts[host]
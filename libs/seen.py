@@ -0,0 +1,73 @@
+# Recently reported urls for TorSpider.
+
+import time
+import math
+import threading
+from hashlib import blake2b
+
+
+class BloomFilter:
+    # A fixed-size set of strings that may mistake a string it hasn't seen
+    # for one it has, about error_rate of the time once it holds capacity
+    # strings, but never the other way around.
+    def __init__(self, capacity, error_rate=0.001):
+        self.size = max(int(-capacity * math.log(error_rate) / math.log(2) ** 2), 8)
+        self.hashes = max(int(round(self.size / capacity * math.log(2))), 1)
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def __positions(self, item):
+        # Derive each of the bit positions from two halves of one hash.
+        digest = blake2b(item.encode('utf-8', 'surrogatepass'),
+                         digest_size=16).digest()
+        a = int.from_bytes(digest[:8], 'little')
+        b = int.from_bytes(digest[8:], 'little') | 1
+        return [(a + n * b) % self.size for n in range(self.hashes)]
+
+    def __contains__(self, item):
+        return all(self.bits[p >> 3] & (1 << (p & 7))
+                   for p in self.__positions(item))
+
+    def add(self, item):
+        for p in self.__positions(item):
+            self.bits[p >> 3] |= 1 << (p & 7)
+        self.count += 1
+
+
+class SeenFilter:
+    # Remembers which urls this node has recently reported, so that each
+    # page only sends the backend the links it hasn't heard about from us
+    # lately. Index sites link to the same urls over and over, and there's
+    # no sense in sending them every time. The urls are kept in two Bloom
+    # filters of capacity urls each: new urls go in the current one, and once
+    # it's full or max_age seconds old it replaces the previous one, which is
+    # forgotten. So a url we haven't come across for a while is reported
+    # again, and memory use never grows. Urls are only remembered once the
+    # backend has actually taken them, so none are lost along with a batch
+    # it didn't. One filter is shared by all of the spiders.
+    def __init__(self, capacity=1000000, max_age=21600, error_rate=0.001):
+        self.capacity = capacity
+        self.max_age = max_age
+        self.error_rate = error_rate
+        self.current = BloomFilter(capacity, error_rate)
+        self.previous = None
+        self.started = time.time()
+        self.lock = threading.Lock()
+
+    def filter(self, urls):
+        # Return those of urls we haven't reported lately.
+        with self.lock:
+            return [url for url in urls if url not in self.current and (
+                self.previous is None or url not in self.previous)]
+
+    def add(self, urls):
+        # Remember urls as reported.
+        with self.lock:
+            if (self.current.count >= self.capacity
+                    or time.time() - self.started >= self.max_age):
+                self.previous = self.current
+                self.current = BloomFilter(self.capacity, self.error_rate)
+                self.started = time.time()
+            for url in urls:
+                if url not in self.current:
+                    self.current.add(url)
@@ -0,0 +1,25 @@
+# Shared state for TorSpider's processes.
+
+from multiprocessing.managers import BaseManager
+from libs.control import Settings
+from libs.health import OfflineCache, TorHealth
+from libs.latency import LatencyTracker
+from libs.metrics import MetricsCollector
+from libs.scheduler import HostScheduler
+from libs.seen import SeenFilter
+
+
+class SpiderManager(BaseManager):
+    # Runs a server process holding the objects that all of the spiders
+    # share. The spiders reach them through proxies, and every method call
+    # is carried out in the manager's process.
+    pass
+
+
+SpiderManager.register('HostScheduler', HostScheduler)
+SpiderManager.register('LatencyTracker', LatencyTracker)
+SpiderManager.register('TorHealth', TorHealth)
+SpiderManager.register('OfflineCache', OfflineCache)
+SpiderManager.register('SeenFilter', SeenFilter)
+SpiderManager.register('MetricsCollector', MetricsCollector)
+SpiderManager.register('Settings', Settings)
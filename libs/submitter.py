@@ -0,0 +1,299 @@
+# Result submission for TorSpider.
+
+import os
+import gzip
+import time
+import queue
+import requests
+import threading
+from libs.logging import logger
+from libs.encoders import decoders, encoders, spool_types
+
+# Status codes with which the backend rejects a batch for good. Sending it
+# again won't help, so it's set aside rather than retried.
+rejected_codes = [400, 415, 422]
+
+# The status code with which the backend turns away a batch that's too big.
+too_large_code = 413
+
+
+class Submitter:
+    # Scan results are queued here and sent to the backend's parse endpoint
+    # by a background thread, so the spider never waits on the backend. The
+    # results are grouped into batches of up to batch_size, or whatever has
+    # arrived within max_wait seconds, then encoded with the named encoder,
+    # gzipped, and sent over one persistent session. Batches the backend
+    # doesn't accept are written to the spool directory and retried later,
+    # so results survive a backend outage; until it's time to retry them,
+    # new batches are spooled straight away rather than waiting on a backend
+    # that's down. Batches too big for the backend are split in half, and
+    # later batches kept smaller than any it turned away. Batches it rejects
+    # for good are moved to the reject directory instead, to be looked into
+    # by hand, so they don't hold up the rest. Each result takes the place
+    # of its url's lease in the journal, if there is one, until it's been
+    # sent or spooled, and results orphaned in the journal by other
+    # processes are sent along too. The journal is only written from our
+    # thread, so the spider never waits on the disk. Once the backend has
+    # taken a batch, its new urls are added to the seen filter, if we have
+    # one.
+    def __init__(self, url, headers, verify=True, batch_size=50, max_wait=5,
+                 spool_dir='spool', retry_wait=30, encoding='json',
+                 journal=None, reject_dir=None, seen=None):
+        self.url = url
+        self.headers = dict(headers)
+        self.headers['Content-Encoding'] = 'gzip'
+        (self.encode, self.content_type, self.extension) = encoders[encoding]
+        self.verify = verify
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.spool_dir = spool_dir
+        self.reject_dir = reject_dir or os.path.join(spool_dir, 'rejected')
+        self.retry_wait = retry_wait
+        self.next_retry = 0
+        # Whether the backend failed to take our last batch.
+        self.outage = False
+        self.closing = False
+        self.journal = journal
+        self.seen = seen
+        self.session = requests.session()
+        self.results = queue.Queue()
+        self.thread = None
+
+    def start(self):
+        # Start the submission thread, if it isn't running. submit() calls
+        # this, so the thread runs in the spider process that queues results
+        # rather than the one that created us.
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.__run, daemon=True)
+            self.thread.start()
+
+    def submit(self, data, url=None):
+        # Queue a scan result, as a dict, to be sent to the backend, along
+        # with the url whose lease it settles.
+        self.start()
+        self.results.put((url, None, data))
+
+    def close(self, timeout=60):
+        # Send off anything still queued, then stop the submission thread.
+        if self.thread is not None:
+            self.results.put(None)
+            self.thread.join(timeout)
+            self.thread = None
+
+    def __len__(self):
+        return self.results.qsize()
+
+    def __run(self):
+        self.closing = False
+        while not self.closing:
+            try:
+                self.__next_batch()
+            except Exception as e:
+                # Whatever went wrong, we have to keep going, or the results
+                # would pile up unsent.
+                logger.exception('Could not submit results: {}', e)
+                time.sleep(1)
+
+    def __next_batch(self):
+        # Wait for the first result, then gather more until the batch is
+        # full or the time window has passed.
+        batch = []
+        deadline = time.time() + self.max_wait
+        while len(batch) < self.batch_size:
+            try:
+                data = self.results.get(
+                    timeout=max(deadline - time.time(), 0) if batch
+                    else self.max_wait)
+            except queue.Empty:
+                break
+            if data is None:
+                self.closing = True
+                break
+            (url, journal_id, data) = data
+            if url is not None and self.journal is not None:
+                journal_id = self.journal.finish(url, data)
+            batch.append((journal_id, data))
+        if batch:
+            self.__deliver(batch)
+        if time.time() >= self.next_retry or self.closing:
+            self.__retry_spool()
+            if self.journal is not None and not self.closing:
+                # Pick up results that processes which have died didn't
+                # get to send.
+                for (journal_id, data) in self.journal.claim_results(
+                        self.batch_size * 10):
+                    self.results.put((None, journal_id, data))
+
+    def __deliver(self, batch):
+        # Send a batch of (journal id, result) tuples to the backend, or
+        # spool it, and acknowledge its results in the journal.
+        payload = gzip.compress(self.encode(
+            [data for (journal_id, data) in batch]))
+        if self.outage and time.time() < self.next_retry:
+            # The backend was down a moment ago, so don't wait on it again
+            # until it's time to retry.
+            sent = 'failed'
+        else:
+            sent = self.__send(payload, self.content_type)
+        if sent == 'too large' and len(batch) > 1:
+            half = len(batch) // 2
+            if self.batch_size >= len(batch):
+                logger.log('Batch too large; sending at most {} results at '
+                           'a time.', 'warning', len(batch) - 1)
+                self.batch_size = len(batch) - 1
+            self.__deliver(batch[:half])
+            self.__deliver(batch[half:])
+            return
+        if sent == 'accepted':
+            self.__mark_seen([data for (journal_id, data) in batch])
+        elif sent == 'failed':
+            self.__spool(payload)
+        else:
+            # Either it's been rejected, or a single result is too big.
+            self.__spool(payload, self.reject_dir)
+        journal_ids = [journal_id for (journal_id, data) in batch
+                       if journal_id is not None]
+        if journal_ids:
+            self.journal.acknowledge(journal_ids)
+
+    def __send(self, payload, content_type):
+        # Send a compressed batch to the backend. Returns 'accepted',
+        # 'too large', 'rejected' if the backend won't ever take it, or
+        # 'failed' if it might later.
+        logger.log('Pushing batch to parse queue.', 'debug')
+        headers = dict(self.headers)
+        headers['Content-Type'] = content_type
+        try:
+            r = self.session.post(self.url, headers=headers,
+                                  data=payload, verify=self.verify,
+                                  timeout=30)
+        except requests.exceptions.RequestException as e:
+            logger.log('Could not reach the parse queue: {}', 'error', e)
+            self.outage = True
+            return 'failed'
+        self.outage = False
+        if r.status_code in [200, 201]:
+            logger.log('Added successfully', 'debug')
+            return 'accepted'
+        elif r.status_code == too_large_code:
+            logger.log('Parse queue turned away a batch as too large', 'debug')
+            return 'too large'
+        elif r.status_code in rejected_codes:
+            logger.log('Parse queue rejected a batch with status code {}',
+                       'error', r.status_code)
+            return 'rejected'
+        elif r.status_code == 401:
+            # Unauthorized.
+            logger.log('Receive 401 Unauthorized', 'error')
+        else:
+            # Some other failure.
+            logger.log('Parse queue returned status code {}', 'error',
+                       r.status_code)
+        self.outage = True
+        return 'failed'
+
+    def __spool(self, payload, directory=None):
+        # Save a batch the backend didn't accept, so we can try it again.
+        directory = directory or self.spool_dir
+        os.makedirs(directory, exist_ok=True)
+        name = '{}-{}{}'.format(time.time_ns(), os.getpid(), self.extension)
+        path = os.path.join(directory, name)
+        with open(path + '.tmp', 'wb') as spool_file:
+            spool_file.write(payload)
+        os.rename(path + '.tmp', path)
+        logger.log('Spooled batch to {}', 'debug', path)
+        self.next_retry = time.time() + self.retry_wait
+
+    def __retry_spool(self):
+        # Try sending any spooled batches again, oldest first, stopping at
+        # the first one the backend still can't take. Those it rejects for
+        # good are moved to the reject directory.
+        try:
+            names = sorted(self.__reclaim(os.listdir(self.spool_dir)))
+        except FileNotFoundError:
+            names = []
+        for name in names:
+            extension = '.' + name.split('.', 1)[-1]
+            if extension not in spool_types:
+                continue
+            path = os.path.join(self.spool_dir, name)
+            claimed = '{}.{}'.format(path, os.getpid())
+            try:
+                # Claim the batch so no other spider sends it too.
+                os.rename(path, claimed)
+            except FileNotFoundError:
+                continue
+            with open(claimed, 'rb') as spool_file:
+                payload = spool_file.read()
+            sent = self.__send(payload, spool_types[extension])
+            if sent == 'accepted':
+                os.unlink(claimed)
+                if self.seen is not None and extension in decoders:
+                    self.__mark_seen(decoders[extension](
+                        gzip.decompress(payload)))
+            elif sent == 'too large' and self.__split(payload, extension):
+                os.unlink(claimed)
+            elif sent in ['rejected', 'too large']:
+                os.makedirs(self.reject_dir, exist_ok=True)
+                os.rename(claimed, os.path.join(self.reject_dir, name))
+                logger.log('Moved rejected batch to {}', 'error',
+                           self.reject_dir)
+            else:
+                os.rename(claimed, path)
+                break
+        self.next_retry = time.time() + self.retry_wait
+
+    def __mark_seen(self, results):
+        # Remember the new urls of results the backend has taken, so we
+        # don't report them again for a while.
+        if self.seen is None:
+            return
+        urls = [url for data in results for url in data.get('new_urls', [])]
+        try:
+            self.seen.add(urls)
+        except Exception as e:
+            logger.log('Could not remember reported urls: {}', 'error', e)
+
+    def __split(self, payload, extension):
+        # Spool a batch again in two halves, to be sent next time. Returns
+        # False if it can't be split.
+        if extension not in decoders:
+            return False
+        batch = decoders[extension](gzip.decompress(payload))
+        if len(batch) < 2:
+            return False
+        half = len(batch) // 2
+        for part in [batch[:half], batch[half:]]:
+            self.__spool(gzip.compress(self.encode(part)))
+        return True
+
+    def __reclaim(self, names):
+        # Put back any batches claimed by spiders that died while sending
+        # them, and return the names of the spool files.
+        found = []
+        for name in names:
+            (base, pid) = name.rsplit('.', 1) if '.' in name else (name, '')
+            if not pid.isdigit() or '.' + base.split('.', 1)[-1] \
+                    not in spool_types:
+                found.append(name)
+                continue
+            if int(pid) != os.getpid():
+                try:
+                    os.kill(int(pid), 0)
+                    # The spider is still sending it.
+                    continue
+                except ProcessLookupError:
+                    pass
+                except PermissionError:
+                    # It's someone else's process, so ours is gone.
+                    pass
+            # A claim with our own pid is left from before a restart, since
+            # we only claim one batch at a time.
+            try:
+                os.rename(os.path.join(self.spool_dir, name),
+                          os.path.join(self.spool_dir, base))
+            except FileNotFoundError:
+                continue
+            logger.log('Reclaimed spooled batch {}', 'debug', base)
+            found.append(base)
+        return found
@@ -0,0 +1,277 @@
+# Spider process supervision for TorSpider.
+
+import os
+import time
+import names
+import signal
+import multiprocessing
+from libs.logging import logger
+from libs.metrics import metrics
+
+
+def run_spider(spider, slot):
+    # The body of each spider process. Ctrl-C is for the supervisor, which
+    # lets the spiders finish up gracefully, so the spiders ignore it.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, terminated)
+    metrics.worker = slot
+    spider.crawl()
+
+
+def terminated(signum, frame):
+    # The supervisor has given up waiting for this spider to finish. Let go
+    # of the shared log queue cleanly before dying.
+    logger.close()
+    os._exit(1)
+
+
+class Supervisor:
+    # Runs the spiders, each in a process of its own. Spiders that die are
+    # replaced, and every interval seconds the number of spiders is adjusted
+    # between min_workers and max_workers, going by the metrics collector:
+    # if the spiders spent more than high_idle of their time waiting for
+    # urls, or responses took more than slow_factor times as long as they
+    # usually do lately, which means Tor is overloaded, one is stopped;
+    # if they spent less than low_idle of their time waiting, one is added.
+    # Spiders that keep dying are replaced after a wait that doubles with
+    # each crash, up to max_backoff seconds.
+    # Each spider has slots urls in flight at once. Spiders are stopped
+    # gracefully, and given grace seconds to finish before being killed.
+    # SIGUSR1 pauses the spiders through control and SIGUSR2 resumes them,
+    # while SIGHUP calls reload, which should return the new settings for
+    # the spiders; a 'concurrency' setting changes the slots. The journal
+    # rows of each spider that exits are handed out to the others. Each
+    # spider is numbered, reusing the numbers of those that have exited,
+    # and its metrics are labelled with its number. A spider that's still
+    # running grace seconds after being asked to stop is sent SIGTERM, so it
+    # can let go of the shared log queue before exiting, and only if that
+    # doesn't work within kill_wait seconds is it killed outright. The spiders rely on
+    # inheriting the main process's globals and locks, so they're always
+    # forked, whatever the platform's default.
+    def __init__(self, make_spider, workers, min_workers=1, max_workers=None,
+                 collector=None, slots=1, interval=60, grace=60,
+                 high_idle=0.5, low_idle=0.1, slow_factor=2, control=None,
+                 reload=None, journal=None, latency_weight=0.2,
+                 max_backoff=60, kill_wait=10):
+        self.make_spider = make_spider
+        self.min_workers = min_workers
+        self.max_workers = max_workers or workers
+        self.target = min(max(workers, min_workers), self.max_workers)
+        self.collector = collector
+        self.slots = slots
+        self.interval = interval
+        self.grace = grace
+        self.high_idle = high_idle
+        self.low_idle = low_idle
+        self.slow_factor = slow_factor
+        self.control = control
+        self.reload = reload
+        self.journal = journal
+        self.latency_weight = latency_weight
+        self.max_backoff = max_backoff
+        self.kill_wait = kill_wait
+        self.context = multiprocessing.get_context('fork')
+        # name: (process, stop event, number)
+        self.workers = {}
+        # name: (process, time it was asked to stop, number)
+        self.draining = {}
+        # When each spider that wouldn't stop was sent SIGTERM, by name.
+        self.terminated = {}
+        self.stopping = False
+        # Signals received, to be dealt with outside of the handlers.
+        self.signals = []
+        self.last_totals = None
+        # A moving average of how long responses take.
+        self.usual_latency = None
+        # When each spider was started, by name.
+        self.started = {}
+        # How many spiders in a row died soon after starting, and when we
+        # may start another.
+        self.crashes = 0
+        self.restart_at = 0
+
+    def run(self):
+        # Run the spiders until the 'sleep' file appears or we're told to
+        # stop, then let them finish up. Only the supervisor looks for the
+        # file, so the spiders don't have to on every url.
+        for signum in [signal.SIGINT, signal.SIGTERM]:
+            signal.signal(signum, self.__stop)
+        if self.control is not None:
+            for signum in [signal.SIGUSR1, signal.SIGUSR2]:
+                signal.signal(signum, self.__signal)
+        if self.reload is not None:
+            signal.signal(signal.SIGHUP, self.__signal)
+        last_scaled = time.time()
+        while not self.stopping and not os.path.exists('sleep'):
+            while self.signals:
+                self.__command(self.signals.pop(0))
+            self.__reap()
+            if (len(self.workers) < self.target
+                    and time.time() >= self.restart_at):
+                # We make them start a second apart so they don't all go
+                # skittering after the same url at the same time.
+                self.__start_worker()
+            elif len(self.workers) > self.target:
+                self.__stop_worker(next(iter(self.workers)))
+            if self.interval and time.time() - last_scaled >= self.interval:
+                if self.control is None or not self.control.paused():
+                    self.__autoscale()
+                last_scaled = time.time()
+            time.sleep(1)
+        self.__drain()
+
+    def __stop(self, signum, frame):
+        logger.log('Received signal {}, stopping the spiders.', 'info', signum)
+        self.stopping = True
+
+    def __signal(self, signum, frame):
+        self.signals.append(signum)
+
+    def __command(self, signum):
+        if signum == signal.SIGUSR1:
+            logger.log('Pausing the spiders.', 'info')
+            self.control.pause()
+        elif signum == signal.SIGUSR2:
+            logger.log('Resuming the spiders.', 'info')
+            # What the spiders did while paused says nothing about how
+            # many we need.
+            self.last_totals = None
+            self.control.resume()
+        elif signum == signal.SIGHUP:
+            try:
+                settings = self.reload()
+            except Exception as e:
+                logger.log('Could not reload settings: {}', 'error', e)
+                return
+            self.slots = settings.get('concurrency', self.slots)
+            if self.control is not None:
+                self.control.reload(settings)
+            logger.log('Reloaded settings: {}', 'info', settings)
+
+    def __start_worker(self):
+        spider = self.make_spider()
+        spider.stop_event = self.context.Event()
+        name = names.get_first_name()
+        while name in self.workers or name in self.draining:
+            name = names.get_first_name()
+        taken = {worker[-1] for worker in list(self.workers.values())
+                 + list(self.draining.values())}
+        number = min(set(range(len(taken) + 1)) - taken)
+        process = self.context.Process(target=run_spider,
+                                       args=(spider, number), name=name)
+        process.start()
+        self.workers[name] = (process, spider.stop_event, number)
+        self.started[name] = time.time()
+
+    def __stop_worker(self, name):
+        # Ask a spider to finish up.
+        (process, stop_event, number) = self.workers.pop(name)
+        stop_event.set()
+        self.draining[name] = (process, time.time(), number)
+
+    def __reap(self):
+        # Clear away spiders that have finished, and kill any that are
+        # taking too long to.
+        for name in list(self.workers.keys()):
+            (process, stop_event, number) = self.workers[name]
+            if not process.is_alive():
+                process.join()
+                del self.workers[name]
+                self.__exited(process, number)
+                lived = time.time() - self.started.pop(name)
+                if process.exitcode != 0:
+                    self.__crashed(name, process.exitcode, lived)
+        for name in list(self.draining.keys()):
+            (process, asked, number) = self.draining[name]
+            if not process.is_alive():
+                process.join()
+                del self.draining[name]
+                self.started.pop(name, None)
+                self.terminated.pop(name, None)
+                self.__exited(process, number)
+            elif name not in self.terminated:
+                if time.time() - asked > self.grace:
+                    logger.log('{} took too long to stop; terminating it.',
+                               'warning', name)
+                    self.terminated[name] = time.time()
+                    process.terminate()
+            elif time.time() - self.terminated[name] > self.kill_wait:
+                # It couldn't even manage that, so there's nothing for it.
+                logger.log("{} didn't respond to SIGTERM; killing it.",
+                           'error', name)
+                process.kill()
+
+    def __crashed(self, name, exitcode, lived):
+        # Replace a spider that died, waiting longer each time if they keep
+        # dying as soon as they start.
+        if lived > max(self.max_backoff, self.interval):
+            self.crashes = 0
+        wait = min(2 ** self.crashes, self.max_backoff)
+        self.crashes += 1
+        self.restart_at = time.time() + wait
+        logger.log('{} died with exit code {}; replacing it in {} seconds.',
+                   'error', name, exitcode, wait)
+
+    def __exited(self, process, number):
+        # Let the other spiders pick up whatever an exited spider left
+        # unfinished, and drop its gauges, which nothing will update now.
+        if self.journal is not None:
+            self.journal.orphan(process.pid)
+            # The next spider is forked from this process, and mustn't
+            # inherit our connection.
+            self.journal.close()
+        if self.collector is not None:
+            try:
+                self.collector.forget(number)
+            except Exception as e:
+                logger.log('Could not drop metrics: {}', 'error', e)
+
+    def __drain(self):
+        # Stop all of the spiders, waiting for them to finish up.
+        for name in list(self.workers.keys()):
+            self.__stop_worker(name)
+        while self.draining:
+            self.__reap()
+            time.sleep(0.5)
+
+    def __autoscale(self):
+        if self.collector is None:
+            return
+        try:
+            totals = (self.collector.total('torspider_idle_seconds_total'),
+                      self.collector.total('torspider_request_seconds'))
+        except Exception as e:
+            logger.log('Could not read metrics: {}', 'error', e)
+            return
+        (last, self.last_totals) = (self.last_totals, totals)
+        if last is None or not self.workers:
+            return
+        idle = (totals[0] - last[0]) / (
+            self.interval * len(self.workers) * self.slots)
+        (latency_sum, latency_count) = [
+            now - before for (now, before) in zip(totals[1], last[1])]
+        latency = latency_sum / latency_count if latency_count else None
+        usual = self.usual_latency
+        if latency is not None:
+            # Compare with how long responses have taken lately rather than
+            # the best we've ever seen, so that one unusually quick interval
+            # doesn't make every one after it look slow.
+            self.usual_latency = latency if usual is None else \
+                usual + self.latency_weight * (latency - usual)
+        if idle > self.high_idle:
+            reason = 'spiders idle {:.0%} of the time'.format(idle)
+            target = self.target - 1
+        elif (latency is not None and usual is not None
+              and latency > usual * self.slow_factor):
+            reason = 'responses taking {:.1f}s'.format(latency)
+            target = self.target - 1
+        elif idle < self.low_idle:
+            reason = 'spiders idle {:.0%} of the time'.format(idle)
+            target = self.target + 1
+        else:
+            return
+        target = min(max(target, self.min_workers), self.max_workers)
+        if target != self.target:
+            logger.log('Scaling from {} to {} spiders: {}.', 'info',
+                       self.target, target, reason)
+            self.target = target
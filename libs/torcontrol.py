@@ -0,0 +1,94 @@
+# Tor control port client for TorSpider.
+
+import re
+import socket
+
+
+class TorControlError(Exception):
+    pass
+
+
+class TorController:
+    # Asks the local Tor client how it's doing through its control port:
+    # how far it has got with bootstrapping, and whether it has managed to
+    # build any circuits. This only ever talks to Tor itself, so it's quick
+    # and doesn't depend on anyone else's website being up.
+    def __init__(self, host='127.0.0.1', port=9051, password=None, timeout=5):
+        self.host = host
+        self.port = port
+        self.password = password
+        self.timeout = timeout
+
+    def status(self):
+        # Return Tor's bootstrap progress as a percentage, and whether it
+        # has established a circuit.
+        with socket.create_connection((self.host, self.port),
+                                      self.timeout) as sock:
+            conn = sock.makefile('rwb')
+            self.__authenticate(conn)
+            info = self.__command(conn, 'GETINFO status/bootstrap-phase '
+                                        'status/circuit-established')
+            self.__command(conn, 'QUIT')
+        values = dict(line.split('=', 1) for line in info if '=' in line)
+        progress = re.search(r'PROGRESS=(\d+)',
+                             values.get('status/bootstrap-phase', ''))
+        return (int(progress.group(1)) if progress else 0,
+                values.get('status/circuit-established') == '1')
+
+    def __authenticate(self, conn):
+        if self.password:
+            password = self.password.replace('\\', '\\\\').replace('"', '\\"')
+            self.__command(conn, 'AUTHENTICATE "{}"'.format(password))
+            return
+        info = ' '.join(self.__command(conn, 'PROTOCOLINFO 1'))
+        methods = re.search(r'METHODS=(\S+)', info)
+        methods = methods.group(1).split(',') if methods else []
+        cookie_file = re.search(r'COOKIEFILE="((?:[^"\\]|\\.)*)"', info)
+        if 'NULL' in methods:
+            self.__command(conn, 'AUTHENTICATE')
+        elif 'COOKIE' in methods and cookie_file:
+            path = re.sub(r'\\(.)', r'\1', cookie_file.group(1))
+            try:
+                with open(path, 'rb') as f:
+                    cookie = f.read()
+            except OSError as e:
+                raise TorControlError('Cannot read the auth cookie: {}'.format(e))
+            self.__command(conn, 'AUTHENTICATE {}'.format(cookie.hex()))
+        else:
+            raise TorControlError(
+                'Tor wants a control port password: {}'.format(','.join(methods)))
+
+    @staticmethod
+    def __command(conn, command):
+        # Send a command, and return the text of each line of the reply.
+        conn.write(command.encode('ascii') + b'\r\n')
+        conn.flush()
+        lines = []
+        while True:
+            line = conn.readline().decode('utf-8', 'replace').rstrip('\r\n')
+            if len(line) < 4:
+                raise TorControlError('Bad reply from Tor: {!r}'.format(line))
+            (code, more, text) = (line[:3], line[3], line[4:])
+            if code != '250':
+                raise TorControlError(line)
+            lines.append(text)
+            if more == '+':
+                # The data follows on lines of its own, up to a lone '.'.
+                while True:
+                    data = conn.readline().decode('utf-8', 'replace').rstrip('\r\n')
+                    if data in ['.', '']:
+                        break
+                    lines.append(data)
+            elif more == ' ':
+                return lines
+
+
+class StubController:
+    # A stand-in for the Tor control port, for trying the spiders out
+    # without one. It reports whatever state it was given.
+    def __init__(self, progress=100, circuits=True):
+        self.progress = progress
+        self.circuits = circuits
+
+    def status(self):
+        return (self.progress, self.circuits)
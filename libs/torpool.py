@@ -0,0 +1,82 @@
+# Tor circuit pool for TorSpider.
+
+import random
+from libs.functions import get_tor_session, get_async_tor_session
+
+
+class Circuit:
+    # One route through Tor: a SocksPort, plus the SOCKS credentials that
+    # keep its streams isolated from those of the other circuits. We keep a
+    # running average of how quickly it responds and how often it fails.
+    def __init__(self, port, isolation=None):
+        self.port = port
+        self.isolation = isolation
+        self.session = get_tor_session(port, isolation)
+        self.async_session = None
+        self.latency = None
+        self.errors = 0.0
+        self.in_flight = 0
+
+    def score(self):
+        # The expected cost of sending a request this way; lower is better.
+        # Circuits we haven't measured yet are tried first.
+        if self.latency is None:
+            return 0
+        return self.latency * (self.in_flight + 1) / max(1 - self.errors, 0.05)
+
+
+class TorPool:
+    # Spreads requests over several Tor SocksPorts, with isolation circuits
+    # on each port, so the spiders aren't limited to a single Tor client's
+    # circuits. Each request goes to the healthier of two randomly chosen
+    # circuits, which favours the fast, reliable ones without piling
+    # everything onto whichever one currently looks best.
+    def __init__(self, ports=None, isolation=1, weight=0.2):
+        ports = [9050] if not ports else ports
+        # A random prefix keeps each spider's circuits apart from the rest.
+        prefix = '{:08x}'.format(random.getrandbits(32))
+        self.circuits = []
+        for port in ports:
+            for n in range(isolation):
+                key = '{}-{}'.format(prefix, n) if isolation > 1 else None
+                self.circuits.append(Circuit(port, key))
+        self.weight = weight
+
+    def choose(self):
+        # Pick a circuit for the next request.
+        if len(self.circuits) == 1:
+            circuit = self.circuits[0]
+        else:
+            (a, b) = random.sample(self.circuits, 2)
+            circuit = a if a.score() <= b.score() else b
+        circuit.in_flight += 1
+        return circuit
+
+    def release(self, circuit, latency=None, failed=False):
+        # Record how a request sent through the circuit went. A latency is
+        # given for requests that got a response, and failed is set for
+        # those that couldn't connect or timed out.
+        circuit.in_flight -= 1
+        if failed:
+            circuit.errors += self.weight * (1 - circuit.errors)
+        elif latency is not None:
+            circuit.errors -= self.weight * circuit.errors
+            if circuit.latency is None:
+                circuit.latency = latency
+            else:
+                circuit.latency += self.weight * (latency - circuit.latency)
+
+    def open_async(self, limit=100):
+        # Create an asyncio session for each circuit, sharing out limit
+        # connections between them. Must be called from within a running
+        # loop.
+        per_circuit = -(-limit // len(self.circuits))
+        for circuit in self.circuits:
+            circuit.async_session = get_async_tor_session(
+                per_circuit, circuit.port, circuit.isolation)
+
+    async def close_async(self):
+        for circuit in self.circuits:
+            if circuit.async_session is not None:
+                await circuit.async_session.close()
+                circuit.async_session = None
@@ -0,0 +1,98 @@
+# Url canonicalization for TorSpider.
+
+import re
+from functools import lru_cache
+from urllib.parse import quote, urljoin, urlsplit, urlunsplit
+
+# The ports we leave out of urls, since they go without saying.
+default_ports = {'http': 80, 'https': 443}
+
+# The schemes of the links we follow.
+web_schemes = ['http', 'https']
+
+# Characters that never need to be percent-encoded.
+unreserved = ('ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz'
+              '0123456789-._~')
+
+# Characters left alone when encoding paths and queries. Anything already
+# percent-encoded stays that way.
+path_safe = "/%:@!$&'()*+,;="
+query_safe = path_safe + '?'
+
+escape = re.compile(r'%([0-9A-Fa-f]{2})')
+
+
+def _fix_escape(match):
+    # Decode escaped characters that didn't need escaping, and write the
+    # rest in upper case.
+    char = chr(int(match.group(1), 16))
+    return char if char in unreserved else '%' + match.group(1).upper()
+
+
+def _encode(part, safe):
+    return escape.sub(_fix_escape, quote(part, safe=safe))
+
+
+def _remove_dots(path):
+    # Resolve the '.' and '..' segments of a path.
+    segments = path.split('/')
+    output = []
+    for segment in segments:
+        if segment == '.':
+            continue
+        if segment == '..':
+            if len(output) > 1:
+                output.pop()
+            continue
+        output.append(segment)
+    if segments[-1] in ['.', '..']:
+        # The path pointed at a directory, so it still does.
+        output.append('')
+    return '/'.join(output)
+
+
+@lru_cache(maxsize=65536)
+def canonical_url(url):
+    # Return the one spelling of url that we crawl, so that the same page
+    # isn't crawled again under another name: the scheme and host in lower
+    # case, no default port, no '.' or '..' in the path, a path of at least
+    # '/', consistent percent-encoding, the query's parameters in order of
+    # key, and no fragment. A trailing slash on the path is kept, since '/a'
+    # and '/a/' can be different pages. Raises ValueError for malformed urls.
+    parts = urlsplit(url.strip())
+    (scheme, path, query) = (parts.scheme, parts.path, parts.query)
+    host = (parts.hostname or '').rstrip('.')
+    if ':' in host:
+        host = '[{}]'.format(host)
+    port = parts.port
+    if port is not None and port != default_ports.get(scheme):
+        host = '{}:{}'.format(host, port)
+    if parts.username is not None:
+        userinfo = parts.username
+        if parts.password is not None:
+            userinfo += ':' + parts.password
+        host = '{}@{}'.format(userinfo, host)
+    path = _encode(_remove_dots(path), path_safe) or '/'
+    if query:
+        # Only the keys are sorted, and the sort is stable, so a key given
+        # more than once keeps its values in order.
+        query = '&'.join(sorted(
+            (_encode(param, query_safe) for param in query.split('&')
+             if param), key=lambda param: param.split('=', 1)[0]))
+    return urlunsplit((scheme, host, path, query, ''))
+
+
+@lru_cache(maxsize=65536)
+def join_url(base, href):
+    # Resolve a link found on the page at base, and return its canonical
+    # form. Returns None for links that aren't to web pages, such as
+    # mailto: and javascript: links. Raises ValueError for malformed urls.
+    href = href.strip()
+    (scheme, netloc, path, query, fragment) = urlsplit(href)
+    if not scheme and not netloc and path.split('/')[0].endswith('.onion'):
+        # A link to an onion, missing its scheme.
+        href = 'http://' + href
+    url = urljoin(base, href)
+    if urlsplit(url)[0] not in web_schemes:
+        return None
+    return canonical_url(url)
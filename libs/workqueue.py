@@ -0,0 +1,121 @@
+# Local work queue for TorSpider.
+
+import time
+import heapq
+import itertools
+import threading
+from collections import deque
+from libs.logging import logger
+
+
+class WorkQueue:
+    # Urls are leased from the backend in batches and held here, so the
+    # spider doesn't need a round trip to the backend for every page. A
+    # background thread tops the queue back up whenever it falls to the
+    # low-water mark, backing off gradually while the backend has nothing
+    # for us rather than sleeping a flat thirty seconds. Urls put off until
+    # later count towards the mark too, so that a batch of urls we can't
+    # scan yet doesn't send us leasing more and more, only for the leases
+    # to run out before we get to them.
+    def __init__(self, lease, batch_size=20, low_water=None,
+                 min_wait=1, max_wait=30):
+        # lease(count) should return a list of urls to scan.
+        self.lease = lease
+        self.batch_size = batch_size
+        self.low_water = batch_size // 4 if low_water is None else low_water
+        self.min_wait = min_wait
+        self.max_wait = max_wait
+        self.wait = min_wait
+        self.urls = deque()
+        # Urls put off until later, as (time, order, url) tuples.
+        self.deferred = []
+        self.order = itertools.count()
+        self.lock = threading.Lock()
+        self.not_empty = threading.Condition(self.lock)
+        self.running_low = threading.Condition(self.lock)
+        self.thread = None
+
+    def start(self):
+        # Start the refill thread. Threads don't survive a fork, so it's
+        # started on first use, once the spider is running in its own process,
+        # rather than at creation.
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.__refill, daemon=True)
+            self.thread.start()
+
+    def get(self, timeout=None):
+        # Return the next url to scan, waiting up to timeout
+        # seconds for one to arrive. Returns None if nothing arrived.
+        self.start()
+        with self.lock:
+            next_url = self.__next(timeout)
+            if next_url is not None and len(self) <= self.low_water:
+                # Let the refill thread know it's time to fetch more.
+                self.running_low.notify()
+            return next_url
+
+    def __next(self, timeout):
+        # Take the next url, with the lock held.
+        if self.deferred and self.deferred[0][0] <= time.time():
+            # A url we put off is ready to try again.
+            return heapq.heappop(self.deferred)[2]
+        if not self.urls and timeout != 0:
+            if self.deferred:
+                wait = max(self.deferred[0][0] - time.time(), 0)
+                timeout = wait if timeout is None else min(timeout, wait)
+            self.not_empty.wait(timeout)
+            if self.deferred and self.deferred[0][0] <= time.time():
+                return heapq.heappop(self.deferred)[2]
+        if not self.urls:
+            return None
+        return self.urls.popleft()
+
+    def defer(self, next_url, delay):
+        # Put off scanning a url for delay seconds, and scan others instead
+        # in the meantime.
+        with self.lock:
+            heapq.heappush(self.deferred,
+                           (time.time() + delay, next(self.order), next_url))
+
+    def ready_in(self, limit):
+        # How long until a url we put off is ready to try again, up to limit
+        # seconds.
+        with self.lock:
+            if not self.deferred:
+                return limit
+            return min(max(self.deferred[0][0] - time.time(), 0), limit)
+
+    def resize(self, batch_size, low_water=None):
+        # Change how many urls we lease at a time.
+        with self.lock:
+            self.batch_size = batch_size
+            self.low_water = (batch_size // 4 if low_water is None
+                              else low_water)
+            self.running_low.notify()
+
+    def __len__(self):
+        return len(self.urls) + len(self.deferred)
+
+    def __refill(self):
+        while True:
+            with self.lock:
+                while len(self) > self.low_water:
+                    self.running_low.wait()
+            try:
+                urls = self.lease(self.batch_size)
+            except Exception as e:
+                logger.log('Could not lease urls: {}', 'error', e)
+                urls = []
+            if urls:
+                logger.log('Leased {} urls.', 'debug', len(urls))
+                with self.lock:
+                    self.urls.extend(urls)
+                    self.not_empty.notify_all()
+                self.wait = self.min_wait
+            else:
+                # There are currently no urls to scan. Wait a little longer
+                # each time, up to max_wait, before trying again.
+                logger.log('We found no urls to check, sleeping for {} seconds.',
+                           'debug', self.wait)
+                time.sleep(self.wait)
+                self.wait = min(self.wait * 2, self.max_wait)
@@ -0,0 +1,90 @@
+# Tests for libs/urls.py.
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from libs.urls import canonical_url, join_url
+
+base = 'http://abc.onion/dir/page.html'
+
+
+def test_scheme_and_host_are_lower_case():
+    assert canonical_url('HTTP://Abc.ONION/Path') == 'http://abc.onion/Path'
+
+
+def test_dot_segments():
+    assert canonical_url('http://abc.onion/a/./b/../c') == \
+        'http://abc.onion/a/c'
+    assert canonical_url('http://abc.onion/a/b/..') == 'http://abc.onion/a/'
+    # There's nothing above the root.
+    assert canonical_url('http://abc.onion/../../x') == 'http://abc.onion/x'
+
+
+def test_empty_path_and_trailing_slash():
+    assert canonical_url('http://abc.onion') == 'http://abc.onion/'
+    assert canonical_url('http://abc.onion/a/') == 'http://abc.onion/a/'
+    assert canonical_url('http://abc.onion/a') == 'http://abc.onion/a'
+
+
+def test_default_ports():
+    assert canonical_url('http://abc.onion:80/') == 'http://abc.onion/'
+    assert canonical_url('https://abc.onion:443/') == 'https://abc.onion/'
+    assert canonical_url('http://abc.onion:443/') == 'http://abc.onion:443/'
+    assert canonical_url('http://abc.onion:8080/') == \
+        'http://abc.onion:8080/'
+
+
+def test_invalid_ports():
+    with pytest.raises(ValueError):
+        canonical_url('http://abc.onion:99999/')
+    with pytest.raises(ValueError):
+        canonical_url('http://abc.onion:port/')
+
+
+def test_percent_encoding():
+    # Unreserved characters are decoded, and the rest are written in upper
+    # case.
+    assert canonical_url('http://abc.onion/%7euser/%2f%e2%82%ac') == \
+        'http://abc.onion/~user/%2F%E2%82%AC'
+    assert canonical_url('http://abc.onion/a b') == 'http://abc.onion/a%20b'
+    assert canonical_url('http://abc.onion/?x=%3d') == \
+        'http://abc.onion/?x=%3D'
+
+
+def test_fragment_is_dropped():
+    assert canonical_url('http://abc.onion/a#top') == 'http://abc.onion/a'
+
+
+def test_query_is_sorted_by_key():
+    assert canonical_url('http://abc.onion/?b=2&a=1&&c') == \
+        'http://abc.onion/?a=1&b=2&c'
+
+
+def test_repeated_query_keys_keep_their_order():
+    assert canonical_url('http://abc.onion/?q=a+b&q=%20') == \
+        'http://abc.onion/?q=a+b&q=%20'
+    assert canonical_url('http://abc.onion/?q=z&a=1&q=a') == \
+        'http://abc.onion/?a=1&q=z&q=a'
+
+
+def test_relative_links():
+    assert join_url(base, 'other.html') == 'http://abc.onion/dir/other.html'
+    assert join_url(base, '../up') == 'http://abc.onion/up'
+    assert join_url(base, '/root') == 'http://abc.onion/root'
+    assert join_url(base, '?q=1') == 'http://abc.onion/dir/page.html?q=1'
+    assert join_url(base, '#top') == 'http://abc.onion/dir/page.html'
+
+
+def test_bare_onion_links():
+    assert join_url(base, 'xyz.onion/path') == 'http://xyz.onion/path'
+    assert join_url(base, 'xyz.onion') == 'http://xyz.onion/'
+
+
+def test_non_web_schemes():
+    assert join_url(base, 'mailto:me@abc.onion') is None
+    assert join_url(base, 'javascript:void(0)') is None
+    assert join_url(base, 'ftp://abc.onion/file') is None